@@ -53,6 +53,8 @@ from readsidebar import Sidebar
 from readtopbar import TopBar
 
 from readdb import AnnotationManager
+from readdb import get_store
+from annosync import SyncCancelled
 import epubadapter
 import evinceadapter
 import textadapter
@@ -72,6 +74,13 @@ _HARDWARE_MANAGER_OBJECT_PATH = '/org/laptop/HardwareManager'
 
 _TOOLBAR_READ = 2
 
+# Seconds after opening a document before the annotation database is
+# compacted
+_DB_MAINTENANCE_DELAY = 120
+
+# Seconds between attempts to send what waits in the annotation outbox
+_OUTBOX_DRAIN_INTERVAL = 5 * 60
+
 _logger = logging.getLogger('anno-activity')
 
 def _get_screen_dpi():
@@ -158,6 +167,8 @@ class AnnoActivity(activity.Activity):
         _logger.debug('Starting Anno...')
         
         self._view = None
+        self._annotationmanager = None
+        self._outbox_timer = None
         self.dpi = _get_screen_dpi()
 
         self._sidebar = Sidebar()
@@ -502,22 +513,12 @@ class AnnoActivity(activity.Activity):
         self._view.next_page()
 
     def __highlight_cb(self, button):
-        tuples_list = self._annotationmanager.get_highlights(
-                self._view.get_current_page())
         selection_tuple = self._view.get_selection_bounds()
         cursor_position = self._view.get_cursor_position()
 
-        old_highlight_found = None
-        for compare_tuple in tuples_list:
-            if selection_tuple:
-                if selection_tuple[0] >= compare_tuple[0] and \
-                        selection_tuple[1] <= compare_tuple[1]:
-                    old_highlight_found = compare_tuple
-                    break
-            if cursor_position >= compare_tuple[0] and \
-               cursor_position <= compare_tuple[1]:
-                old_highlight_found = compare_tuple
-                break
+        old_highlight_found = self._annotationmanager.find_highlight(
+                self._view.get_current_page(), selection_tuple,
+                cursor_position)
 
         if old_highlight_found == None:
             self._annotationmanager.add_highlight(
@@ -565,11 +566,46 @@ class AnnoActivity(activity.Activity):
             self._sidebar.add_annotation(page)
 
     def __annotator_syncer_toggled_cb(self, button):
-        self._sidebar.sync_annotations()
+        self._toggle_sync(button, self._annotator_syncer_toggle_handler_id,
+                _('Sync annotations'), self._sidebar.sync_annotations)
 
 
     def __annotator_downloader_toggled_cb(self, button):
-        self._sidebar.download_annotations()
+        self._toggle_sync(button, self._annotator_downloader_toggle_handler_id,
+                _('Download annotations'), self._sidebar.download_annotations)
+
+    def _toggle_sync(self, button, handler_id, tooltip, start_sync):
+        # The button stays down while the sync runs in the background;
+        # raising it again cancels the sync
+        if not button.props.active:
+            self._sidebar.cancel_sync()
+            return
+
+        def raise_button():
+            button.handler_block(handler_id)
+            button.props.active = False
+            button.handler_unblock(handler_id)
+
+        def done_cb(error):
+            raise_button()
+            if error is None or isinstance(error, SyncCancelled):
+                button.set_tooltip(tooltip)
+            else:
+                button.set_tooltip(_('Could not reach the annotation server'))
+
+        def progress_cb(stage, done, total):
+            if stage == 'fetch':
+                button.set_tooltip(_('Contacting the annotation server...'))
+            elif stage == 'delete':
+                button.set_tooltip(_('Deleting annotations: %(done)d of %(total)d')
+                        % {'done': done, 'total': total})
+            else:
+                button.set_tooltip(_('Sending annotations: %(done)d of %(total)d')
+                        % {'done': done, 'total': total})
+
+        if start_sync(done_cb, progress_cb) is None:
+            # another sync is still running
+            raise_button()
 
     def __page_changed_cb(self, model, page_from, page_to):
         self._update_nav_buttons()
@@ -584,6 +620,8 @@ class AnnoActivity(activity.Activity):
                 self._view.get_current_page())
         if self._view.can_highlight():
             self._view.show_highlights(tuples_list)
+            gobject.idle_add(self._annotationmanager.prefetch_highlights,
+                    self._view.get_current_page())
 
 
 
@@ -738,6 +776,10 @@ class AnnoActivity(activity.Activity):
             # Workaround for closing Anno with no document loaded
             raise NotImplementedError
 
+        # Annotation and bookmark writes are committed in the background;
+        # make sure they are on disk before the journal entry is
+        self._flush_managers()
+
         try:
             self.metadata['Anno_current_page'] = \
                         str(self._model.props.page)
@@ -775,8 +817,22 @@ class AnnoActivity(activity.Activity):
         Called from self.close()
         """
         self._close_requested = True
+        if self._outbox_timer is not None:
+            gobject.source_remove(self._outbox_timer)
+            self._outbox_timer = None
+        if self._annotationmanager is not None:
+            self._annotationmanager.cancel_sync()
+        self._flush_managers()
         return True
 
+    def _flush_managers(self):
+        # A flush also reloads a manager whose writes failed
+        if self._annotationmanager is not None:
+            self._annotationmanager.flush()
+        bookmarkmanager = self._sidebar.get_bookmarkmanager()
+        if bookmarkmanager is not None:
+            bookmarkmanager.flush()
+
     def _download_result_cb(self, getter, tempfile, suggested_name, tube_id):
         if self._download_content_type == 'text/html':
             # got an error page instead
@@ -909,6 +965,14 @@ class AnnoActivity(activity.Activity):
         filehash = get_md5(filepath)
         self._annotationmanager = AnnotationManager(filehash, self._mimetype, self._sidebar)
         self._sidebar.set_annotationmanager(self._annotationmanager)
+        self._annotationmanager.connect_page_counts_handler(
+                self._view.show_annotation_density)
+        self._view.show_annotation_density(
+                self._annotationmanager.get_page_counts())
+        gobject.timeout_add_seconds(_DB_MAINTENANCE_DELAY,
+                self.__db_maintenance_timeout_cb)
+        self._outbox_timer = gobject.timeout_add_seconds(
+                _OUTBOX_DRAIN_INTERVAL, self.__outbox_drain_timeout_cb)
         self._update_nav_buttons()
         self._update_toc()
         self._view.connect_page_changed_handler(self.__page_changed_cb)
@@ -930,6 +994,22 @@ class AnnoActivity(activity.Activity):
         except Exception, e:
             _logger.debug('Sharing failed: %s', e)
 
+    def __db_maintenance_timeout_cb(self):
+        # wait for the main loop to go idle before queueing it
+        gobject.idle_add(self.__db_maintenance_idle_cb,
+                priority=gobject.PRIORITY_LOW)
+        return False
+
+    def __db_maintenance_idle_cb(self):
+        get_store().schedule_maintenance()
+        return False
+
+    def __outbox_drain_timeout_cb(self):
+        # a sync replays the outbox itself
+        if not self._annotationmanager.is_syncing():
+            self._annotationmanager.drain_outbox()
+        return True
+
     def _update_toolbars(self):
         self._view_toolbar._update_zoom_buttons()
         if not self._view.can_highlight():
@@ -1008,20 +1088,9 @@ class AnnoActivity(activity.Activity):
             cursor_position = self._view.get_cursor_position()
             logging.debug('cursor position %d' % cursor_position)
             selection_tuple = self._view.get_selection_bounds()
-            tuples_list = self._annotationmanager.get_highlights( \
-                    self._view.get_current_page())
-            in_bounds = False
-            for highlight_tuple in tuples_list:
-                logging.debug('control tuple  %s' % str(highlight_tuple))
-                if selection_tuple:
-                    if selection_tuple[0] >= highlight_tuple[0] and \
-                       selection_tuple[1] <= highlight_tuple[1]:
-                        in_bounds = True
-                        break
-                if cursor_position >= highlight_tuple[0] and \
-                   cursor_position <= highlight_tuple[1]:
-                    in_bounds = True
-                    break
+            in_bounds = self._annotationmanager.find_highlight( \
+                    self._view.get_current_page(), selection_tuple,
+                    cursor_position) is not None
 
             self._highlight.props.sensitive = \
                     view.get_has_selection() or in_bounds
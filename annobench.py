@@ -0,0 +1,153 @@
+# Copyright 2009 One Laptop Per Child
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301  USA
+
+"""Measures how syncs with the annotation server scale.
+
+Runs the stand-in server of annoserver.py in this process, and for every
+size times three operations against it:
+
+  download  fetch that many annotations by someone else into a new book
+  upload    sync a book with that many annotations of our own, unsent
+  resync    sync the same book again, when nothing has changed
+
+and reports the wall time, the number of requests and the bytes that
+went each way. The latency option holds every request back, to stand in
+for a slow link.
+
+    python annobench.py [--sizes 100,1000,10000,50000] [--latency 0.3]
+
+Needs the sugar environment, like the activity itself, and Python 2.6
+for the server. The annotation database goes to a temporary directory.
+"""
+
+import logging
+import optparse
+import os
+import shutil
+import tempfile
+import time
+
+import gobject
+import simplejson
+
+from annohttp import get_pool
+from annoserver import AnnoServer
+
+_logger = logging.getLogger('anno-activity')
+
+_SIZES = (100, 1000, 10000, 50000)
+
+
+class _Sidebar:
+    def update_for_page(self, page):
+        pass
+
+
+def _remote_annotation(md5, i):
+    now = time.time()
+    return {'id': i, 'md5': md5, 'page': i % 300,
+            'title': 'Annotation %d' % i,
+            'content': 'Some words about page %d' % (i % 300),
+            'bodyurl': '', 'texttitle': 'A Book to Measure With',
+            'textcreator': 'Someone', 'created': now, 'modified': now,
+            'creator': 'bench-reader', 'annotates': '',
+            'color': '#FF2B34,#005FE4', 'local': 1, 'mimetype': 'text/plain',
+            'uuid': 'urn:bench:%s:%d' % (md5, i), 'annotationurl': ''}
+
+
+def _run_sync(server, start):
+    # start(done_cb) starts a sync job; the main loop runs until it is over
+    loop = gobject.MainLoop()
+    errors = []
+
+    def done_cb(error):
+        errors.append(error)
+        loop.quit()
+
+    server.reset_stats()
+    started = time.time()
+    if start(done_cb) is None:
+        raise RuntimeError('a sync is already running')
+    loop.run()
+    elapsed = time.time() - started
+    if errors[0] is not None:
+        raise errors[0]
+    return elapsed, dict(server.stats)
+
+
+def _report(size, operation, elapsed, stats):
+    print '%8d  %-9s %9.2f %9d %11.1f %11.1f' % (size, operation, elapsed,
+            stats['requests'], stats['bytes_received'] / 1024.0,
+            stats['bytes_sent'] / 1024.0)
+
+
+def run(sizes, latency):
+    # readdb finds the database and the server through the environment
+    os.environ['SUGAR_ACTIVITY_ROOT'] = tempfile.mkdtemp(prefix='annobench')
+    os.environ.setdefault('SUGAR_BUNDLE_PATH',
+                          os.path.dirname(os.path.abspath(__file__)))
+    server = AnnoServer(latency=latency)
+    server.start()
+    os.environ['ANNO_SERVER_URL'] = server.get_url()
+    from readdb import AnnotationManager, get_store
+
+    print '    size  operation   seconds  requests    sent KiB    recv KiB'
+    try:
+        for size in sizes:
+            md5 = 'bench-download-%d' % size
+            for i in range(size):
+                server.store.store(_remote_annotation(md5, i), server.get_url())
+            manager = AnnotationManager(md5, 'text/plain', _Sidebar())
+            elapsed, stats = _run_sync(server, manager.download_annotations)
+            _report(size, 'download', elapsed, stats)
+
+            manager = AnnotationManager('bench-upload-%d' % size, 'text/plain',
+                                        _Sidebar())
+            # the first sync looks the user id up, so adding makes no requests
+            _run_sync(server, manager.sync_annotations)
+            for i in range(size):
+                manager.add_annotation(i % 300, simplejson.dumps(
+                        {'title': 'Note %d' % i, 'body': 'Thoughts on page %d' % (i % 300)}))
+            manager.flush()
+            elapsed, stats = _run_sync(server, manager.sync_annotations)
+            _report(size, 'upload', elapsed, stats)
+            elapsed, stats = _run_sync(server, manager.sync_annotations)
+            _report(size, 'resync', elapsed, stats)
+    finally:
+        get_store().flush()
+        get_pool().close()
+        server.stop()
+        shutil.rmtree(os.environ['SUGAR_ACTIVITY_ROOT'], True)
+
+
+def main():
+    parser = optparse.OptionParser(usage='%prog [options]')
+    parser.add_option('--sizes', default=','.join([str(s) for s in _SIZES]),
+                      help='comma separated numbers of annotations')
+    parser.add_option('--latency', type='float', default=0,
+                      help='seconds to hold every request back for')
+    options, args = parser.parse_args()
+    try:
+        sizes = [int(s) for s in options.sizes.split(',')]
+    except ValueError:
+        parser.error('sizes must be numbers')
+    logging.basicConfig(level=logging.WARNING)
+    gobject.threads_init()
+    run(sizes, options.latency)
+
+
+if __name__ == '__main__':
+    main()
@@ -23,8 +23,22 @@ from sugar.graphics.xocolor import XoColor
 
 _logger = logging.getLogger('anno-activity')
 
+# Color string -> XoColor, shared by all records so that thousands of
+# annotations by a handful of people only parse a handful of colors
+_xocolors = {}
+
+def get_xocolor(color_string):
+    xocolor = _xocolors.get(color_string)
+    if xocolor is None:
+        xocolor = XoColor(color_string)
+        _xocolors[color_string] = xocolor
+    return xocolor
+
+
+class Bookmark(object):
+    __slots__ = ('md5', 'page_no', 'content', 'timestamp', 'nick', 'color',
+                 'local', '_note')
 
-class Bookmark:
     def __init__(self, data):
         self.md5 = data[0]
         self.page_no = data[1]
@@ -33,6 +47,7 @@ class Bookmark:
         self.nick = data[4]
         self.color = data[5]
         self.local = data[6]
+        self._note = None
         
     def belongstopage(self, page_no):
         return self.page_no == page_no 
@@ -40,59 +55,114 @@ class Bookmark:
     def is_local(self):
         return bool(self.local)
 
+    def _get_note(self):
+        # content is only decoded once
+        if self._note is None:
+            self._note = simplejson.loads(self.content)
+            #self._note = cjson.decode(self.content)
+        return self._note
+
     def get_note_title(self):
         if self.content == '' or self.content is None:
             return ''
-
-        note = simplejson.loads(self.content)
-        #note = cjson.decode(self.content)
-
-        return note['title']
+        return self._get_note()['title']
 
     def get_note_body(self):
         if self.content == '' or self.content is None:
             return ''
-        
-        note = simplejson.loads(self.content)
-        #note = cjson.decode(self.content)
-        return note['body']
+        return self._get_note()['body']
         
 
 
 
-class AnnoBookmark:
-    def __init__(self, data):
+# The columns left out of a summary row, in the order a loader returns them
+DETAIL_COLUMNS = ('title', 'content', 'bodyurl', 'texttitle', 'textcreator',
+                  'annotates', 'mimetype')
+
+
+def _detail_property(name):
+    slot = '_' + name
+    def getter(self):
+        if self._loader is not None:
+            self._load_details()
+        return getattr(self, slot)
+    def setter(self, value):
+        if self._loader is not None:
+            self._load_details()
+        setattr(self, slot, value)
+    return property(getter, setter)
+
+
+class AnnoBookmark(object):
+    """An annotation.
+
+    When created from a summary row, with a loader, the detail columns
+    (title, body, urls and the like) are not set yet: loader(self) is
+    called to fetch them the first time any of them is used.
+    """
+    __slots__ = ('id', 'md5', 'page', '_title', '_content', '_bodyurl',
+                 '_texttitle', '_textcreator', 'created', 'modified', 'creator',
+                 '_annotates', '_color', 'local', '_mimetype', 'uuid',
+                 'annotationurl', '_loader')
+
+    def __init__(self, data, loader=None):
         self.id = data[0]
         self.md5 = data[1]
         self.page = data[2]
-        self.title = data[3]
-        self.content = data[4]
-        self.bodyurl = data[5]
-        self.texttitle = data[6]
-        self.textcreator = data[7]
+        self._title = data[3]
+        self._content = data[4]
+        self._bodyurl = data[5]
+        self._texttitle = data[6]
+        self._textcreator = data[7]
         self.created = data[8]
         self.modified = data[9]
         self.creator = data[10]
-        self.annotates = data[11]
-
-        if isinstance(data[12], str) or isinstance(data[12], unicode):
-            self.color = XoColor(data[12])
-        elif isinstance(data[12], XoColor):
-            self.color = data[12]
-        else:
-            self.color = XoColor(" ")
-
+        self._annotates = data[11]
+        # a color string, parsed on first use, or an XoColor
+        self._color = data[12]
         self.local = data[13]
-        self.mimetype = data[14]
+        self._mimetype = data[14]
         self.uuid = data[15]
         self.annotationurl = data[16]
-        if ( ( self.uuid == None ) or ( len( self.uuid ) == 0 ) ):
+        self._loader = loader
+        if not self.uuid:
             self.make_new_uuid()
-        _logger.debug('annobookmark annotates is %s' % self.annotates)
 
         if ( self.annotationurl == None ):
             self.annotationurl = ''
 
+    title = _detail_property('title')
+    content = _detail_property('content')
+    bodyurl = _detail_property('bodyurl')
+    texttitle = _detail_property('texttitle')
+    textcreator = _detail_property('textcreator')
+    annotates = _detail_property('annotates')
+    mimetype = _detail_property('mimetype')
+
+    def has_details(self):
+        return self._loader is None
+
+    def _load_details(self):
+        loader = self._loader
+        self._loader = None
+        row = loader(self)
+        if row is not None:
+            for name, value in zip(DETAIL_COLUMNS, row):
+                setattr(self, '_' + name, value)
+
+    def _get_color(self):
+        if not isinstance(self._color, XoColor):
+            if isinstance(self._color, basestring):
+                self._color = get_xocolor(self._color)
+            else:
+                self._color = get_xocolor(" ")
+        return self._color
+
+    def _set_color(self, color):
+        self._color = color
+
+    color = property(_get_color, _set_color)
+
     
     def __str__(self):
         r  = str( "A bookmark: id: %s \nuuid: %s" % ( str( self.id ), self.uuid ) )
@@ -201,7 +271,11 @@ class AnnoBookmark:
         return self.uuid 
 
     def get_json(self):
-        arr = {
+        return simplejson.dumps(self.get_json_dict())
+        #return cjson.encode(self.get_json_dict())
+
+    def get_json_dict(self):
+        return {
         'id' : self.id,
         'md5' : self.md5,
         'page' : self.page,
@@ -220,5 +294,3 @@ class AnnoBookmark:
         'uuid' : self.uuid,
         'annotationurl' : self.annotationurl
         }
-        return simplejson.dumps(arr)
-        #return cjson.encode(arr)
@@ -0,0 +1,197 @@
+# Copyright 2009 One Laptop Per Child
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301  USA
+
+"""Export and import of one book's annotations, highlights and bookmarks.
+
+A bundle is a line-delimited file (gzip compressed when its name ends in
+.gz). The first line is a JSON header naming the book's md5 and the
+columns of each record type; every following line is one record, a JSON
+array whose first element is its type: 'a' for an annotation, 'h' for a
+highlight and 'b' for a bookmark. Both directions stream, so a bundle
+never has to fit in memory.
+"""
+
+import gzip
+import logging
+
+import simplejson
+
+_logger = logging.getLogger('anno-activity')
+
+BUNDLE_VERSION = 1
+
+# Rows are inserted in batches of this many
+_BATCH_SIZE = 500
+
+_ANNOTATION_COLUMNS = ('page', 'title', 'content', 'bodyurl', 'texttitle',
+        'textcreator', 'created', 'modified', 'creator', 'annotates', 'color',
+        'local', 'mimetype', 'uuid', 'annotationurl')
+_HIGHLIGHT_COLUMNS = ('page', 'init_pos', 'end_pos')
+# the bookmarks table has an oddly quoted content column, so bookmarks
+# are always read by position
+_BOOKMARK_COLUMNS = ('page', 'content', 'timestamp', 'user', 'color', 'local')
+
+
+def _open(path, mode):
+    if path.endswith('.gz'):
+        return gzip.open(path, mode)
+    return open(path, mode)
+
+
+def _dump(fileobj, obj):
+    fileobj.write(simplejson.dumps(obj, separators=(',', ':')))
+    fileobj.write('\n')
+
+
+def export_book(conn, filehash, path):
+    """Write the book's records to a bundle at path; returns how many
+    records of each type were written."""
+    counts = {'a': 0, 'h': 0, 'b': 0}
+    fileobj = _open(path, 'wb')
+    try:
+        _dump(fileobj, {'version': BUNDLE_VERSION, 'md5': filehash,
+                        'a': _ANNOTATION_COLUMNS, 'h': _HIGHLIGHT_COLUMNS,
+                        'b': _BOOKMARK_COLUMNS})
+        rows = conn.execute('select ' + ', '.join(_ANNOTATION_COLUMNS) +
+                ' from annotations where md5=? order by page, id', (filehash, ))
+        for row in rows:
+            _dump(fileobj, ['a'] + list(row))
+            counts['a'] += 1
+        rows = conn.execute('select page, init_pos, end_pos from highlights '
+                'where md5=? order by page, init_pos', (filehash, ))
+        for row in rows:
+            _dump(fileobj, ['h'] + list(row))
+            counts['h'] += 1
+        rows = conn.execute('select * from bookmarks where md5=? order by page',
+                (filehash, ))
+        for row in rows:
+            _dump(fileobj, ['b'] + list(row[1:]))
+            counts['b'] += 1
+    finally:
+        fileobj.close()
+    return counts
+
+
+def import_book(conn, filehash, path, result):
+    """Read a bundle into the database as a single transaction.
+
+    Meant to run on the writer thread. Annotations whose uuid is already
+    known for the book, locally or as a tombstone, are skipped, as are
+    duplicate highlights and bookmarks. Annotations get new ids from
+    sqlite. The counts of imported records, or the error, are stored in
+    result.
+    """
+    # commit whatever was queued before, so a failed import only rolls
+    # back its own rows
+    conn.commit()
+    try:
+        result['counts'] = _import_records(conn, filehash, path)
+        conn.commit()
+    except Exception, e:
+        conn.rollback()
+        _logger.error('importing bundle %s failed: %s', path, e)
+        result['error'] = e
+
+
+def _import_records(conn, filehash, path):
+    seen_uuids = set()
+    for row in conn.execute('select uuid from annotations where md5=?',
+                            (filehash, )):
+        seen_uuids.add(row[0])
+    for row in conn.execute('select uuid from deleted_annotations where md5=?',
+                            (filehash, )):
+        seen_uuids.add(row[0])
+    seen_highlights = set(conn.execute('select page, init_pos, end_pos '
+            'from highlights where md5=?', (filehash, )).fetchall())
+    seen_bookmarks = set(conn.execute('select page, timestamp, user '
+            'from bookmarks where md5=?', (filehash, )).fetchall())
+
+    counts = {'a': 0, 'h': 0, 'b': 0}
+    annotations = []
+    highlights = []
+    bookmarks = []
+
+    def flush_annotations():
+        if annotations:
+            conn.executemany('insert into annotations values (?, ?, ?, ?, ?, '
+                    '?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                    [(None, filehash) + tuple(a) for a in annotations])
+            counts['a'] += len(annotations)
+            del annotations[:]
+
+    def flush_highlights():
+        if highlights:
+            conn.executemany('insert into highlights values (?, ?, ?, ?)',
+                    [(filehash, ) + tuple(h) for h in highlights])
+            counts['h'] += len(highlights)
+            del highlights[:]
+
+    def flush_bookmarks():
+        if bookmarks:
+            conn.executemany('insert into bookmarks values (?, ?, ?, ?, ?, ?, ?)',
+                    [(filehash, ) + tuple(b) for b in bookmarks])
+            counts['b'] += len(bookmarks)
+            del bookmarks[:]
+
+    fileobj = _open(path, 'rb')
+    try:
+        header = simplejson.loads(fileobj.readline())
+        if header.get('version') != BUNDLE_VERSION:
+            raise ValueError('unsupported bundle version %s' %
+                             header.get('version'))
+        if header.get('md5') != filehash:
+            raise ValueError('bundle belongs to another book (%s)' %
+                             header.get('md5'))
+
+        uuid_pos = _ANNOTATION_COLUMNS.index('uuid')
+        for line in fileobj:
+            if not line.strip():
+                continue
+            record = simplejson.loads(line)
+            kind, values = record[0], record[1:]
+            if kind == 'a':
+                uuid = values[uuid_pos]
+                if uuid and uuid in seen_uuids:
+                    continue
+                seen_uuids.add(uuid)
+                annotations.append(values)
+                if len(annotations) >= _BATCH_SIZE:
+                    flush_annotations()
+            elif kind == 'h':
+                key = tuple(values)
+                if key in seen_highlights:
+                    continue
+                seen_highlights.add(key)
+                highlights.append(values)
+                if len(highlights) >= _BATCH_SIZE:
+                    flush_highlights()
+            elif kind == 'b':
+                key = (values[0], values[2], values[3])
+                if key in seen_bookmarks:
+                    continue
+                seen_bookmarks.add(key)
+                bookmarks.append(values)
+                if len(bookmarks) >= _BATCH_SIZE:
+                    flush_bookmarks()
+            else:
+                _logger.debug('skipping unknown bundle record %s', kind)
+
+        flush_annotations()
+        flush_highlights()
+        flush_bookmarks()
+    finally:
+        fileobj.close()
+    return counts
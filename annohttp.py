@@ -0,0 +1,326 @@
+# Copyright 2009 One Laptop Per Child
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301  USA
+
+import httplib
+import logging
+import socket
+import threading
+import time
+import urllib
+import urlparse
+import zlib
+
+_logger = logging.getLogger('anno-activity')
+
+# Idle connections kept per server, and for how many seconds; servers
+# usually drop keep-alive connections after a minute or so themselves
+_MAX_IDLE = 2
+_IDLE_TIMEOUT = 50
+
+DEFAULT_TIMEOUT = 30
+
+# Bytes read from the socket at a time when streaming a response
+CHUNK_SIZE = 16 * 1024
+
+# Request bodies smaller than this are not worth compressing
+_MIN_COMPRESS_SIZE = 1024
+
+
+def _gzip(data):
+    compressor = zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    return compressor.compress(data) + compressor.flush()
+
+
+class HTTPError(Exception):
+    def __init__(self, code, reason, body=''):
+        Exception.__init__(self, 'HTTP %d %s' % (code, reason))
+        self.code = code
+        self.reason = reason
+        self.body = body
+
+
+class StreamedResponse:
+    """The body of a response, read as it arrives.
+
+    Iterating gives the body in chunks of up to CHUNK_SIZE bytes read
+    from the socket, decompressed if the server gzipped them. Once the
+    body has been read to its end the connection goes back to the pool;
+    close() a response that is not read to the end.
+    """
+    def __init__(self, pool, key, conn, response):
+        self._pool = pool
+        self._key = key
+        self._conn = conn
+        self._response = response
+        self.status = response.status
+        self.reason = response.reason
+        self._decompressor = None
+        encoding = (response.getheader('content-encoding') or '').lower()
+        if encoding in ('gzip', 'x-gzip'):
+            self._decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+
+    def read(self, amt=CHUNK_SIZE):
+        while self._conn is not None:
+            try:
+                data = self._response.read(amt)
+                if self._decompressor is not None:
+                    if data:
+                        data = self._decompressor.decompress(data)
+                    else:
+                        data = self._decompressor.flush()
+                        self._decompressor = None
+            except:
+                self.close()
+                raise
+            if not data and self._decompressor is None:
+                self._release()
+            # a compressed chunk can decompress to nothing
+            if data:
+                return data
+        return ''
+
+    def __iter__(self):
+        while True:
+            data = self.read()
+            if not data:
+                return
+            yield data
+
+    def close(self):
+        # the rest of the body is still on the wire, so the connection
+        # cannot be reused
+        if self._conn is not None:
+            self._conn.close()
+            self._conn = None
+
+    def _release(self):
+        if self._response.will_close:
+            self._conn.close()
+        else:
+            self._pool._put_connection(self._key, self._conn)
+        self._conn = None
+
+
+class ConnectionPool:
+    """Keeps connections to the annotation server open between requests.
+
+    Every request to the server used to open a new TCP (and maybe TLS)
+    connection, which costs several round trips on a slow link. Here a
+    connection goes back to the pool once its response has been read,
+    and the next request to the same server reuses it. The pool can be
+    used from several threads; a connection is only ever used by one
+    request at a time. Proxies set in the environment are honoured.
+    Redirects are not followed.
+
+    Responses are asked for gzipped. Request bodies are gzipped when the
+    caller allows it and the server has said it takes them, by naming
+    gzip in an Accept-Encoding header of an earlier response (RFC 7694).
+    A server that then answers 415 gets the request again uncompressed.
+    """
+    def __init__(self, max_idle=_MAX_IDLE, idle_timeout=_IDLE_TIMEOUT):
+        self._max_idle = max_idle
+        self._idle_timeout = idle_timeout
+        self._lock = threading.Lock()
+        # (scheme, host, port) -> [(connection, time returned)]
+        self._idle = {}
+        # (scheme, host, port) -> whether gzipped request bodies are taken
+        self._takes_gzip = {}
+
+    def post(self, url, data, headers=None, timeout=DEFAULT_TIMEOUT,
+             stream=False, compress=False):
+        headers = dict(headers or {})
+        if 'Content-Type' not in headers:
+            headers['Content-Type'] = 'application/x-www-form-urlencoded'
+        return self.request('POST', url, data, headers, timeout, stream,
+                            compress)
+
+    def request(self, method, url, body=None, headers=None,
+                timeout=DEFAULT_TIMEOUT, stream=False, compress=False):
+        """Make a request and return the body of the response, or with
+        stream a StreamedResponse to read it from. With compress the body
+        may be sent gzipped. Raises HTTPError for error statuses, and
+        socket or httplib errors when the server cannot be reached."""
+        scheme, host, port, path = self._split_url(url)
+        key = (scheme, host, port)
+        headers = dict(headers or {})
+        if 'Accept-Encoding' not in headers:
+            headers['Accept-Encoding'] = 'gzip'
+
+        if compress and body and len(body) >= _MIN_COMPRESS_SIZE and \
+                self._takes_gzip.get(key):
+            gzip_headers = dict(headers)
+            gzip_headers['Content-Encoding'] = 'gzip'
+            response = self._open(key, method, path, _gzip(body),
+                                  gzip_headers, timeout)
+            if response.status != 415:
+                return self._finish(response, stream)
+            ''.join(response)
+            _logger.debug('%s does not take gzipped requests after all', host)
+            self._takes_gzip[key] = False
+        return self._finish(self._open(key, method, path, body, headers,
+                                       timeout), stream)
+
+    def _finish(self, response, stream):
+        if stream and response.status < 400:
+            return response
+        data = ''.join(response)
+        if response.status >= 400:
+            raise HTTPError(response.status, response.reason, data)
+        return data
+
+    def _open(self, key, method, path, body, headers, timeout):
+        conn, reused = self._get_connection(key, timeout)
+        try:
+            response = self._send(conn, method, path, body, headers, timeout)
+        except (httplib.HTTPException, socket.error), e:
+            conn.close()
+            if not reused:
+                raise
+            # the server closed the idle connection; try a fresh one once
+            _logger.debug('annotation server dropped a kept-alive connection: %s', e)
+            conn, reused = self._new_connection(key, timeout), False
+            try:
+                response = self._send(conn, method, path, body, headers, timeout)
+            except:
+                conn.close()
+                raise
+
+        # a server that turned a gzipped request down is not asked again
+        accept = response.getheader('accept-encoding')
+        if accept is not None and self._takes_gzip.get(key) is not False:
+            self._takes_gzip[key] = 'gzip' in accept.lower()
+        return StreamedResponse(self, key, conn, response)
+
+    def close(self):
+        self._lock.acquire()
+        try:
+            idle = self._idle
+            self._idle = {}
+        finally:
+            self._lock.release()
+        for connections in idle.values():
+            for conn, returned in connections:
+                conn.close()
+
+    def _split_url(self, url):
+        parts = urlparse.urlsplit(url)
+        scheme = parts.scheme.lower()
+        if scheme not in ('http', 'https'):
+            raise ValueError('unsupported url %s' % url)
+        port = parts.port
+        if port is None:
+            port = scheme == 'https' and httplib.HTTPS_PORT or httplib.HTTP_PORT
+        path = parts.path or '/'
+        if parts.query:
+            path += '?' + parts.query
+        return scheme, parts.hostname, port, path
+
+    def _send(self, conn, method, path, body, headers, timeout):
+        if conn.sock is None:
+            conn.connect()
+        conn.sock.settimeout(timeout)
+        if getattr(conn, 'proxied', False):
+            # a plain http proxy wants the absolute url
+            path = 'http://%s:%d%s' % (conn.target[0], conn.target[1], path)
+        conn.request(method, path, body, headers)
+        return conn.getresponse()
+
+    def _get_connection(self, key, timeout):
+        now = time.time()
+        stale = []
+        conn = None
+        self._lock.acquire()
+        try:
+            connections = self._idle.get(key, [])
+            while connections:
+                candidate, returned = connections.pop()
+                if now - returned < self._idle_timeout:
+                    conn = candidate
+                    break
+                stale.append(candidate)
+        finally:
+            self._lock.release()
+        for candidate in stale:
+            candidate.close()
+        if conn is not None:
+            return conn, True
+        return self._new_connection(key, timeout), False
+
+    def _put_connection(self, key, conn):
+        self._lock.acquire()
+        try:
+            connections = self._idle.setdefault(key, [])
+            if len(connections) < self._max_idle:
+                connections.append((conn, time.time()))
+                conn = None
+        finally:
+            self._lock.release()
+        if conn is not None:
+            conn.close()
+
+    def _new_connection(self, key, timeout):
+        scheme, host, port = key
+        proxy = None
+        if not urllib.proxy_bypass(host):
+            proxy = urllib.getproxies().get(scheme)
+        if scheme == 'https':
+            connection_class = httplib.HTTPSConnection
+        else:
+            connection_class = httplib.HTTPConnection
+        if not proxy:
+            return _connection(connection_class, host, port, timeout)
+
+        proxy_parts = urlparse.urlsplit(proxy)
+        proxy_host = proxy_parts.hostname
+        proxy_port = proxy_parts.port or httplib.HTTP_PORT
+        conn = _connection(connection_class, proxy_host, proxy_port, timeout)
+        if scheme == 'https':
+            # set_tunnel is new in Python 2.7, 2.6.3 has it as _set_tunnel
+            set_tunnel = getattr(conn, 'set_tunnel', None) or \
+                    getattr(conn, '_set_tunnel', None)
+            if set_tunnel is None:
+                _logger.debug('httplib cannot tunnel through %s, connecting directly', proxy)
+                return _connection(connection_class, host, port, timeout)
+            set_tunnel(host, port)
+        else:
+            conn.proxied = True
+            conn.target = (host, port)
+        return conn
+
+
+def _connection(connection_class, host, port, timeout):
+    try:
+        return connection_class(host, port, timeout=timeout)
+    except TypeError:
+        # Python 2.5 takes no timeout; _send sets it once connected
+        return connection_class(host, port)
+
+
+_pool = None
+_pool_lock = threading.Lock()
+
+
+def get_pool():
+    """Return the connection pool shared by all annotation server
+    requests."""
+    global _pool
+    _pool_lock.acquire()
+    try:
+        if _pool is None:
+            _pool = ConnectionPool()
+        return _pool
+    finally:
+        _pool_lock.release()
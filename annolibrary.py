@@ -0,0 +1,95 @@
+# Copyright 2009 One Laptop Per Child
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301  USA
+
+"""Queries over the annotations of every book in the database.
+
+Results come a page at a time. Each query returns its rows together with
+a cursor to pass back for the next page, or None after the last one.
+Pages are found by seeking an index past the cursor rather than with
+OFFSET, so page 1000 is as cheap to read as page 1.
+"""
+
+import logging
+
+from annobookmark import AnnoBookmark
+from readdb import get_store, ANNOTATION_SUMMARY_COLUMNS
+
+_logger = logging.getLogger('anno-activity')
+
+_PAGE_SIZE = 50
+
+
+class AnnotationLibrary:
+    def __init__(self, store=None):
+        if store is None:
+            store = get_store()
+        self._store = store
+        self._conn = store.conn
+
+    def _annotations_page(self, where, params, after, limit):
+        # Newest first; the cursor is the (modified, id) of the last row.
+        # modified <= ? keeps the index range, the rest breaks ties.
+        self._store.flush()
+        sql = 'select ' + ANNOTATION_SUMMARY_COLUMNS + ' from annotations where ' + where
+        params = list(params)
+        if after is not None:
+            sql += ' and modified <= ? and (modified < ? or id < ?)'
+            params += [after[0], after[0], after[1]]
+        sql += ' order by modified desc, id desc limit ?'
+        params.append(limit)
+        rows = self._conn.execute(sql, params).fetchall()
+
+        loader = self._store.load_annotation_details
+        annotations = [AnnoBookmark(row, loader) for row in rows]
+        if len(rows) < limit:
+            return annotations, None
+        return annotations, (rows[-1][9], rows[-1][0])
+
+    def annotations_by_creator(self, creator, after=None, limit=_PAGE_SIZE):
+        """Annotations by creator in every book, newest first."""
+        return self._annotations_page('creator = ?', (creator, ), after, limit)
+
+    def annotations_modified_between(self, start, end, after=None,
+                                     limit=_PAGE_SIZE):
+        """Annotations last modified in start <= modified < end, newest
+        first."""
+        return self._annotations_page('modified >= ? and modified < ?',
+                                      (start, end), after, limit)
+
+    def _counts_page(self, column, after, limit):
+        # Grouping walks an index on column, without touching the table
+        self._store.flush()
+        sql = 'select %s, count(*) from annotations where %s is not null' % \
+                (column, column)
+        params = []
+        if after is not None:
+            sql += ' and %s > ?' % column
+            params.append(after)
+        sql += ' group by %s order by %s limit ?' % (column, column)
+        params.append(limit)
+        rows = self._conn.execute(sql, params).fetchall()
+
+        if len(rows) < limit:
+            return rows, None
+        return rows, rows[-1][0]
+
+    def book_counts(self, after=None, limit=_PAGE_SIZE):
+        """(md5, number of annotations) for every annotated book."""
+        return self._counts_page('md5', after, limit)
+
+    def creator_counts(self, after=None, limit=_PAGE_SIZE):
+        """(creator, number of annotations) for every creator."""
+        return self._counts_page('creator', after, limit)
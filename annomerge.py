@@ -0,0 +1,95 @@
+# Copyright 2009 One Laptop Per Child
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301  USA
+
+"""Reconciliation of local annotations with the server's copies.
+
+plan_merge() only decides; it does not touch the database, the UI or the
+network, and needs nothing but objects with uuid, modified, creator and
+annotationurl attributes, such as AnnoBookmark. Every lookup is in a
+dict or a set, so a plan takes time linear in the number of annotations.
+"""
+
+
+class MergePlan:
+    """What to do to bring local and remote annotations together.
+
+    insert: remote annotations that are new here
+    update_local: (local, remote) pairs where the remote copy is newer
+    push_remote: local annotations the server lacks or has older copies of
+    skip: remote annotations that need nothing, or are deleted here
+    """
+    def __init__(self):
+        self.insert = []
+        self.update_local = []
+        self.push_remote = []
+        self.skip = []
+
+
+def plan_merge(local, remote, tombstones=(), owner=None, tolerance=0,
+               insert_new=True, push_unsynced=False, last_push=None,
+               seen=None):
+    """Plan the merge of the remote annotations into the local ones.
+
+    local maps uuids to the local annotations, and tombstones holds the
+    uuids of annotations deleted here. Remote annotations that are newer
+    than the local copy by more than tolerance seconds update it; local
+    copies by owner that are newer than the remote one are pushed.
+    Remote annotations unknown here are inserted if insert_new is set.
+
+    With push_unsynced, owner's local annotations that the remote set
+    does not mention are pushed too, if they have no annotation url yet
+    or were modified at or after last_push (all of them when last_push
+    is None).
+
+    A remote set can be merged in parts, as it arrives, by passing the
+    same seen set to the call for every part; it collects the remote
+    uuids met so far. push_unsynced then belongs to the last call only.
+    """
+    plan = MergePlan()
+    if not isinstance(tombstones, (set, frozenset)):
+        tombstones = set(tombstones)
+    if seen is None:
+        seen = set()
+    for r in remote:
+        uuid = r.uuid
+        if uuid in seen:
+            plan.skip.append(r)
+            continue
+        seen.add(uuid)
+        if uuid in tombstones:
+            plan.skip.append(r)
+            continue
+        l = local.get(uuid)
+        if l is None:
+            if insert_new:
+                plan.insert.append(r)
+            else:
+                plan.skip.append(r)
+        elif l.modified < r.modified - tolerance:
+            plan.update_local.append((l, r))
+        elif l.modified > r.modified and owner and l.creator == owner:
+            plan.push_remote.append(l)
+        else:
+            plan.skip.append(r)
+
+    if push_unsynced and owner:
+        for uuid, l in local.iteritems():
+            if uuid in seen or l.creator != owner:
+                continue
+            if not l.annotationurl or last_push is None or \
+                    l.modified >= last_push:
+                plan.push_remote.append(l)
+    return plan
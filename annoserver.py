@@ -0,0 +1,272 @@
+# Copyright 2009 One Laptop Per Child
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301  USA
+
+"""A stand-in for the annotation server, to sync against without the
+network.
+
+It speaks the index.php protocol that AnnotationManager uses, with form
+posts for queries (checksum or w3c_hasTarget, and modified_since or
+after_seq), user ids (getidforuser) and deletes (delete_anid), and JSON
+posts of one annotation or an array of them. Annotations are kept in
+memory. Every annotation stored gets the next sequence number as its
+seq, which clients use as their cursor, since modified times come from
+the clients' clocks.
+Responses are gzipped for clients that accept it, and gzipped request
+bodies are taken. Every request can be held back for a given latency,
+and the server counts requests and bytes.
+
+    python annoserver.py [--port 8080] [--latency 0.3]
+
+Unlike the activity, which runs on Python 2.5, this needs Python 2.6.
+
+then start the activity with
+ANNO_SERVER_URL=http://localhost:8080/anno/index.php
+"""
+
+import BaseHTTPServer
+import SocketServer
+import gzip
+import logging
+import optparse
+import StringIO
+import threading
+import time
+import urllib
+import urlparse
+import zlib
+try:
+    from urlparse import parse_qs
+except ImportError:
+    from cgi import parse_qs
+
+import simplejson
+
+_logger = logging.getLogger('anno-activity')
+
+SERVER_PATH = '/anno/index.php'
+
+
+class AnnotationStore:
+    """The annotations and user ids the stand-in server knows about."""
+    def __init__(self):
+        self._lock = threading.Lock()
+        # uuid -> annotation dict
+        self._annotations = {}
+        self._userids = {}
+        self._next_id = 1
+        self._next_seq = 1
+
+    def get_userid(self, user):
+        self._lock.acquire()
+        try:
+            if user not in self._userids:
+                self._userids[user] = str(len(self._userids) + 1)
+            return self._userids[user]
+        finally:
+            self._lock.release()
+
+    def query(self, checksum=None, target=None, modified_since=None,
+              after_seq=None):
+        """The annotations of a book, found by md5 or by target url, in
+        the order they were stored."""
+        self._lock.acquire()
+        try:
+            found = []
+            for a in self._annotations.itervalues():
+                if target is not None:
+                    if a.get('annotates') != target:
+                        continue
+                elif a.get('md5') != checksum:
+                    continue
+                if modified_since is not None and \
+                        float(a.get('modified') or 0) < modified_since:
+                    continue
+                if after_seq is not None and a['seq'] <= after_seq:
+                    continue
+                found.append(a)
+        finally:
+            self._lock.release()
+        found.sort(key=lambda a: a['seq'])
+        return found
+
+    def store(self, annotation, base_url):
+        """Store an annotation, new or not, and return its urls."""
+        self._lock.acquire()
+        try:
+            uuid = annotation['uuid']
+            old = self._annotations.get(uuid)
+            annotation = dict(annotation)
+            if old is not None:
+                annotation['id'] = old['id']
+            else:
+                annotation['id'] = self._next_id
+                self._next_id += 1
+            annotation['seq'] = self._next_seq
+            self._next_seq += 1
+            quoted = urllib.quote(uuid, '')
+            annotation['annotationurl'] = '%s?anid=%s' % (base_url, quoted)
+            annotation['bodyurl'] = '%s?body=%s' % (base_url, quoted)
+            self._annotations[uuid] = annotation
+            return {'annotationurl': annotation['annotationurl'],
+                    'bodyurl': annotation['bodyurl']}
+        finally:
+            self._lock.release()
+
+    def delete(self, uuid):
+        self._lock.acquire()
+        try:
+            self._annotations.pop(uuid, None)
+        finally:
+            self._lock.release()
+
+    def __len__(self):
+        return len(self._annotations)
+
+
+class AnnoRequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def do_POST(self):
+        server = self.server
+        body = self.rfile.read(int(self.headers.get('Content-Length') or 0))
+        server.count(1, len(body), 0)
+        if server.latency:
+            time.sleep(server.latency)
+        if urlparse.urlsplit(self.path).path != SERVER_PATH:
+            self._respond(404, '')
+            return
+        if (self.headers.get('Content-Encoding') or '').lower() == 'gzip':
+            try:
+                body = gzip.GzipFile(fileobj=StringIO.StringIO(body)).read()
+            except (IOError, zlib.error):
+                self._respond(400, '')
+                return
+
+        try:
+            if (self.headers.get('Content-Type') or '').startswith('application/json'):
+                result = self._store(simplejson.loads(body))
+            else:
+                result = self._form(parse_qs(body))
+        except (ValueError, KeyError, TypeError), e:
+            _logger.debug('annoserver: bad request: %s', e)
+            self._respond(400, '')
+            return
+        self._respond(200, simplejson.dumps(result))
+
+    def _store(self, annotations):
+        base_url = self.server.get_url()
+        store = self.server.store
+        if isinstance(annotations, list):
+            urls = {}
+            for a in annotations:
+                urls[a['uuid']] = store.store(a, base_url)
+            return urls
+        return store.store(annotations, base_url)
+
+    def _form(self, form):
+        store = self.server.store
+        values = dict([(k, v[0]) for k, v in form.iteritems()])
+        if 'getidforuser' in values:
+            return {'userid': store.get_userid(values['getidforuser'])}
+        if 'delete_anid' in values:
+            store.delete(values['delete_anid'])
+        modified_since = values.get('modified_since')
+        if modified_since is not None:
+            modified_since = float(modified_since)
+        after_seq = values.get('after_seq')
+        if after_seq is not None:
+            after_seq = int(after_seq)
+        if 'w3c_hasTarget' not in values and 'checksum' not in values:
+            raise KeyError('checksum')
+        return store.query(values.get('checksum'), values.get('w3c_hasTarget'),
+                           modified_since, after_seq)
+
+    def _respond(self, status, data):
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        # gzipped request bodies are welcome, see RFC 7694
+        self.send_header('Accept-Encoding', 'gzip')
+        if data and 'gzip' in (self.headers.get('Accept-Encoding') or '').lower():
+            compressor = zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+            data = compressor.compress(data) + compressor.flush()
+            self.send_header('Content-Encoding', 'gzip')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+        self.server.count(0, 0, len(data))
+
+    def log_message(self, format, *args):
+        _logger.debug('annoserver: ' + format, *args)
+
+
+class AnnoServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    """The stand-in server. latency is the number of seconds every request
+    is held back for. start() serves from a thread of its own."""
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, port=0, latency=0, store=None):
+        BaseHTTPServer.HTTPServer.__init__(self, ('127.0.0.1', port),
+                                           AnnoRequestHandler)
+        self.latency = latency
+        self.store = store or AnnotationStore()
+        self._stats_lock = threading.Lock()
+        self.reset_stats()
+        self._thread = None
+
+    def get_url(self):
+        return 'http://127.0.0.1:%d%s' % (self.server_port, SERVER_PATH)
+
+    def count(self, requests, received, sent):
+        self._stats_lock.acquire()
+        try:
+            self.stats['requests'] += requests
+            self.stats['bytes_received'] += received
+            self.stats['bytes_sent'] += sent
+        finally:
+            self._stats_lock.release()
+
+    def reset_stats(self):
+        self.stats = {'requests': 0, 'bytes_received': 0, 'bytes_sent': 0}
+
+    def start(self):
+        self._thread = threading.Thread(target=self.serve_forever,
+                                        name='annoserver')
+        self._thread.setDaemon(True)
+        self._thread.start()
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+
+def main():
+    parser = optparse.OptionParser(usage='%prog [options]')
+    parser.add_option('--port', type='int', default=8080)
+    parser.add_option('--latency', type='float', default=0,
+                      help='seconds to hold every request back for')
+    options, args = parser.parse_args()
+    logging.basicConfig(level=logging.DEBUG)
+    server = AnnoServer(options.port, options.latency)
+    print 'serving annotations at http://localhost:%d%s' % (options.port, SERVER_PATH)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,120 @@
+# Copyright 2009 One Laptop Per Child
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301  USA
+
+"""Parsing of a JSON array as its text arrives.
+
+The annotation server answers a fetch with one JSON array that can run to
+megabytes. Reading it whole and then parsing it holds the text and the
+parsed list in memory at once; iter_json_array() instead yields each
+element as soon as its text is complete, and keeps no more than the
+element being read.
+"""
+
+import re
+
+import simplejson
+
+_WHITESPACE = re.compile(r'[ \t\n\r]*')
+_DELIMITERS = ' \t\n\r,]'
+
+# What ArrayReader expects next
+_OPEN, _FIRST, _VALUE, _SEPARATOR, _DONE = range(5)
+
+
+class ArrayReader:
+    """Splits a JSON array fed to it in pieces into its elements.
+
+    feed() returns the elements completed by the new text, close() checks
+    that the array ended. An element is parsed once it may be complete;
+    when that fails it is only tried again after its text has doubled, so
+    an element spread over many pieces costs linear time all the same.
+    Malformed text is only reported at close(), since until then it may
+    just be incomplete.
+    """
+    def __init__(self):
+        self._decoder = simplejson.JSONDecoder()
+        self._buf = ''
+        self._state = _OPEN
+        # bytes the element in the buffer needs before it is tried again
+        self._wanted = 0
+
+    def feed(self, data):
+        self._buf += data
+        return self._parse(False)
+
+    def close(self):
+        elements = self._parse(True)
+        if self._state != _DONE:
+            raise ValueError('JSON array ends early')
+        return elements
+
+    def _parse(self, final):
+        buf = self._buf
+        pos = 0
+        elements = []
+        while True:
+            pos = _WHITESPACE.match(buf, pos).end()
+            if pos == len(buf):
+                break
+            c = buf[pos]
+            if self._state == _OPEN:
+                if c != '[':
+                    raise ValueError('expected a JSON array')
+                self._state = _FIRST
+                pos += 1
+            elif self._state == _DONE:
+                raise ValueError('extra data after the JSON array at %d' % pos)
+            elif self._state == _SEPARATOR or (self._state == _FIRST and c == ']'):
+                if c == ',':
+                    self._state = _VALUE
+                elif c == ']':
+                    self._state = _DONE
+                else:
+                    raise ValueError('expected , or ] at %d' % pos)
+                pos += 1
+            else:
+                available = len(buf) - pos
+                if not final and available < self._wanted:
+                    break
+                try:
+                    value, end = self._decoder.raw_decode(buf, pos)
+                except ValueError:
+                    if final:
+                        raise
+                    self._wanted = 2 * available
+                    break
+                # a number or literal may go on in the next piece, unless
+                # something that cannot be part of it follows
+                if not final and c not in '{["' and \
+                        (end == len(buf) or buf[end] not in _DELIMITERS):
+                    self._wanted = available + 1
+                    break
+                self._wanted = 0
+                elements.append(value)
+                self._state = _SEPARATOR
+                pos = end
+        self._buf = buf[pos:]
+        return elements
+
+
+def iter_json_array(chunks):
+    """Yield the elements of the JSON array whose text comes in chunks."""
+    reader = ArrayReader()
+    for chunk in chunks:
+        for element in reader.feed(chunk):
+            yield element
+    for element in reader.close():
+        yield element
@@ -0,0 +1,129 @@
+# Copyright 2009 One Laptop Per Child
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301  USA
+
+import logging
+import sys
+import threading
+
+import gobject
+
+from annohttp import get_pool, DEFAULT_TIMEOUT
+
+_logger = logging.getLogger('anno-activity')
+
+# Seconds to wait for the annotation server before giving up on a request
+REQUEST_TIMEOUT = DEFAULT_TIMEOUT
+
+
+class SyncCancelled(Exception):
+    pass
+
+
+def post(url, data, headers=None, timeout=REQUEST_TIMEOUT, stream=False,
+         compress=False):
+    """POST data to url and return the body of the response, over a
+    kept-alive connection when there is one. With stream, return an
+    annohttp.StreamedResponse instead; with compress, data may travel
+    gzipped if the server takes that."""
+    return get_pool().post(url, data, headers, timeout, stream, compress)
+
+
+class SyncJob(threading.Thread):
+    """Runs a sync with the annotation server on a worker thread.
+
+    job(sync_job) is a generator function. It runs on the worker thread
+    and does the network I/O and parsing there. Whenever it needs the
+    database or the UI it yields (func, args): func(*args) is then run on
+    the main loop, through gobject.idle_add, and its result is sent back
+    into the generator. Exceptions raised by func are thrown back into it.
+    Plain functions running on the worker for the job can do the same
+    with call(func, *args).
+
+    done_cb(error) is called on the main loop once the job is over, with
+    None, a SyncCancelled or whatever exception ended the job.
+    progress_cb(stage, done, total) is called on the main loop whenever
+    the job reports progress.
+    """
+    def __init__(self, job, done_cb=None, progress_cb=None):
+        threading.Thread.__init__(self, name='anno-sync')
+        self.setDaemon(True)
+        self._job = job
+        self._done_cb = done_cb
+        self._progress_cb = progress_cb
+        self._cancelled = False
+
+    def cancel(self):
+        # The request in flight, if any, still runs to its end or its
+        # timeout; nothing is applied after it
+        self._cancelled = True
+
+    def is_cancelled(self):
+        return self._cancelled
+
+    def progress(self, stage, done, total):
+        if self._progress_cb is not None and not self._cancelled:
+            gobject.idle_add(self._progress_cb, stage, done, total)
+
+    def call(self, func, *args):
+        # Runs func(*args) on the main loop and returns its result
+        if self._cancelled:
+            raise SyncCancelled()
+        result, exc_info = self._call_in_main_loop(func, args)
+        if exc_info is not None:
+            raise exc_info[0], exc_info[1], exc_info[2]
+        return result
+
+    def run(self):
+        error = None
+        steps = self._job(self)
+        try:
+            result = None
+            exc_info = None
+            while True:
+                if self._cancelled:
+                    raise SyncCancelled()
+                if exc_info is not None:
+                    step = steps.throw(*exc_info)
+                else:
+                    step = steps.send(result)
+                result, exc_info = self._call_in_main_loop(step[0], step[1])
+        except StopIteration:
+            pass
+        except SyncCancelled, e:
+            _logger.debug('annotation sync cancelled')
+            error = e
+        except Exception, e:
+            _logger.error('annotation sync failed: %s', e)
+            error = e
+        steps.close()
+        if self._done_cb is not None:
+            gobject.idle_add(self._done_cb, error)
+
+    def _call_in_main_loop(self, func, args):
+        done = threading.Event()
+        outcome = [None, None]
+
+        def run_step():
+            try:
+                outcome[0] = func(*args)
+            except Exception:
+                outcome[1] = sys.exc_info()
+            done.set()
+            return False
+
+        gobject.idle_add(run_step)
+        done.wait()
+        return outcome
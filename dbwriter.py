@@ -0,0 +1,184 @@
+# Copyright 2009 One Laptop Per Child
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301  USA
+
+import atexit
+import logging
+import sqlite3
+import threading
+import time
+import Queue
+
+_logger = logging.getLogger('anno-activity')
+
+# Queued writes are committed once this many are pending, or once the
+# oldest uncommitted one has waited this many seconds
+_BATCH_SIZE = 64
+_BATCH_DELAY = 2.0
+
+_EXECUTE = 0
+_EXECUTEMANY = 1
+_CALL = 2
+_FLUSH = 3
+_STOP = 4
+_CALL_WAIT = 5
+
+_writers = {}
+_writers_lock = threading.Lock()
+
+
+def get_writer(dbpath):
+    """Return the writer thread for dbpath, starting it if needed."""
+    _writers_lock.acquire()
+    try:
+        writer = _writers.get(dbpath)
+        if writer is None or not writer.isAlive():
+            writer = DBWriter(dbpath)
+            writer.start()
+            _writers[dbpath] = writer
+        return writer
+    finally:
+        _writers_lock.release()
+
+
+def _stop_writers():
+    for writer in _writers.values():
+        writer.stop()
+
+atexit.register(_stop_writers)
+
+
+class DBWriter(threading.Thread):
+    """Owns the write connection to the annotation database.
+
+    Mutations are queued by the GTK main loop and executed here, so a
+    commit (and the fsync that comes with it) never blocks the UI.
+    Writes are committed in batches; flush() waits until everything
+    queued before it is on disk.
+
+    A write that fails cannot be reported to whoever queued it, who has
+    moved on and may have cached what it wrote. Failures are counted
+    instead, and flush() returns the count so far; a caller that sees it
+    grow knows its cache may no longer match the database.
+
+    call_and_wait() is for writes whose result is needed at once, such
+    as the id sqlite gives a new row.
+    """
+    def __init__(self, dbpath):
+        threading.Thread.__init__(self, name='anno-db-writer')
+        self.setDaemon(True)
+        self._dbpath = dbpath
+        self._queue = Queue.Queue()
+        self.failures = 0
+
+    def execute(self, sql, params=()):
+        self._queue.put((_EXECUTE, sql, params))
+
+    def executemany(self, sql, seq_of_params):
+        self._queue.put((_EXECUTEMANY, sql, list(seq_of_params)))
+
+    def call(self, func, *args):
+        """Run func(conn, *args) on the writer thread, inside the
+        current batch."""
+        self._queue.put((_CALL, func, args))
+
+    def call_and_wait(self, func, *args):
+        """Run func(conn, *args) on the writer thread, inside the
+        current batch, and return its result once it has run. Nothing is
+        committed by this; an exception raised by func is raised here."""
+        if not self.isAlive():
+            raise sqlite3.OperationalError('the db writer has stopped')
+        done = threading.Event()
+        result = {}
+        self._queue.put((_CALL_WAIT, func, (args, done, result)))
+        done.wait()
+        if 'error' in result:
+            raise result['error']
+        return result['value']
+
+    def flush(self):
+        if not self.isAlive():
+            return self.failures
+        done = threading.Event()
+        self._queue.put((_FLUSH, done, None))
+        done.wait()
+        return self.failures
+
+    def stop(self):
+        if not self.isAlive():
+            return
+        self._queue.put((_STOP, None, None))
+        self.join()
+
+    def run(self):
+        conn = sqlite3.connect(self._dbpath)
+        conn.execute('PRAGMA synchronous=NORMAL')
+
+        pending = 0
+        deadline = 0
+        while True:
+            try:
+                if pending:
+                    op, arg1, arg2 = self._queue.get(True,
+                            max(0, deadline - time.time()))
+                else:
+                    op, arg1, arg2 = self._queue.get()
+            except Queue.Empty:
+                pending = self._commit(conn, pending)
+                continue
+
+            if op == _FLUSH:
+                pending = self._commit(conn, pending)
+                arg1.set()
+                continue
+            elif op == _STOP:
+                self._commit(conn, pending)
+                break
+
+            if op == _CALL_WAIT:
+                args, done, result = arg2
+                try:
+                    result['value'] = arg1(conn, *args)
+                except Exception, e:
+                    result['error'] = e
+                done.set()
+            else:
+                try:
+                    if op == _EXECUTE:
+                        conn.execute(arg1, arg2)
+                    elif op == _EXECUTEMANY:
+                        conn.executemany(arg1, arg2)
+                    else:
+                        arg1(conn, *arg2)
+                except Exception, e:
+                    _logger.error('db writer: write failed: %s', e)
+                    self.failures += 1
+
+            if not pending:
+                deadline = time.time() + _BATCH_DELAY
+            pending += 1
+            if pending >= _BATCH_SIZE:
+                pending = self._commit(conn, pending)
+
+        conn.close()
+
+    def _commit(self, conn, pending):
+        if pending:
+            try:
+                conn.commit()
+            except sqlite3.Error, e:
+                _logger.error('db writer: commit failed: %s', e)
+                self.failures += pending
+        return 0
@@ -4,6 +4,8 @@ import logging
 import epubview
 import speech
 
+from scrollmarkers import ScrollMarkers
+
 from cStringIO import StringIO
 
 _logger = logging.getLogger('read-activity')
@@ -21,6 +23,9 @@ class EpubViewer(epubview.EpubView):
 
         activity._hbox.pack_start(self, expand=True, fill=True)
         self.show_all()
+        # epub pages count from 1, and the scrollbar's values are pages
+        self._scroll_markers = ScrollMarkers(self._scrollbar,
+                self.get_pagecount, first_page=1, page_values=True)
         # text to speech initialization
         self.current_word = 0
         self.word_tuples = []
@@ -57,6 +62,9 @@ class EpubViewer(epubview.EpubView):
     def can_highlight(self):
         return False
 
+    def show_annotation_density(self, page_counts):
+        self._scroll_markers.set_page_counts(page_counts)
+
     def can_do_text_to_speech(self):
         return True
 
@@ -4,6 +4,8 @@ import gtk
 
 import evince
 
+from scrollmarkers import ScrollMarkers
+
 _logger = logging.getLogger('read-activity')
 
 
@@ -12,6 +14,7 @@ class EvinceViewer():
     def __init__(self):
         self._view_notify_zoom_handler = None
         self._view = evince.View()
+        self._document = None
 
     def setup(self, activity):
         self._activity = activity
@@ -29,6 +32,10 @@ class EvinceViewer():
         activity._hbox.pack_start(activity._scrolled, expand=True, fill=True)
         activity._scrolled.show()
 
+        # in continuous mode the vertical scrollbar spans every page
+        self._scroll_markers = ScrollMarkers(
+                activity._scrolled.get_vscrollbar(), self.get_pagecount)
+
         self.dpi = activity.dpi
 
     def load_document(self, file_path):
@@ -60,8 +67,10 @@ class EvinceViewer():
 
     def get_pagecount(self):
         '''
-        Returns the pagecount of the loaded file
+        Returns the pagecount of the loaded file, 0 if none is loaded
         '''
+        if self._document is None:
+            return 0
         return self._document.get_n_pages()
 
     def load_metadata(self, activity):
@@ -113,6 +122,9 @@ class EvinceViewer():
     def can_highlight(self):
         return False
 
+    def show_annotation_density(self, page_counts):
+        self._scroll_markers.set_page_counts(page_counts)
+
     def can_do_text_to_speech(self):
         return False
 
@@ -0,0 +1,73 @@
+# Copyright 2009 One Laptop Per Child
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301  USA
+
+from bisect import bisect_left, bisect_right
+
+
+class HighlightIndex:
+    """The highlighted ranges of one page.
+
+    Overlapping and touching ranges are merged when they are added, so
+    the ranges stay disjoint. That keeps both the start and the end
+    offsets sorted, and any hit test is a single bisection.
+    """
+    def __init__(self, ranges=()):
+        self._starts = []
+        self._ends = []
+        for start, end in ranges:
+            self.add(start, end)
+
+    def __len__(self):
+        return len(self._starts)
+
+    def ranges(self):
+        return zip(self._starts, self._ends)
+
+    def find(self, start, end=None):
+        """Return the range containing the offset start, or the whole of
+        start..end when end is given, or None."""
+        if end is None:
+            end = start
+        i = bisect_right(self._starts, start) - 1
+        if i >= 0 and self._ends[i] >= end:
+            return (self._starts[i], self._ends[i])
+        return None
+
+    def add(self, start, end):
+        """Add start..end, merging it with the ranges it overlaps or
+        touches.
+
+        Returns the resulting range and the list of existing ranges that
+        were merged into it.
+        """
+        lo = bisect_left(self._ends, start)
+        hi = bisect_right(self._starts, end)
+        merged = zip(self._starts[lo:hi], self._ends[lo:hi])
+        if merged:
+            start = min(start, self._starts[lo])
+            end = max(end, self._ends[hi - 1])
+        self._starts[lo:hi] = [start]
+        self._ends[lo:hi] = [end]
+        return (start, end), merged
+
+    def remove(self, start, end):
+        i = bisect_left(self._starts, start)
+        if i < len(self._starts) and self._starts[i] == start and \
+                self._ends[i] == end:
+            del self._starts[i]
+            del self._ends[i]
+            return True
+        return False
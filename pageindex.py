@@ -0,0 +1,104 @@
+# Copyright 2009 One Laptop Per Child
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301  USA
+
+from bisect import bisect_left, bisect_right, insort
+
+
+class PageIndex:
+    """Maps page numbers to the items stored on them.
+
+    The pages that hold at least one item are kept in a sorted array, so
+    finding the neighbouring page of any page is a bisection instead of
+    a scan. Items keep their insertion order within a page.
+    """
+    def __init__(self):
+        self._pages = []
+        self._items = {}
+
+    def __len__(self):
+        return len(self._pages)
+
+    def clear(self):
+        self._pages = []
+        self._items = {}
+
+    def add(self, page, item):
+        if page in self._items:
+            self._items[page].append(item)
+        else:
+            self._items[page] = [item]
+            insort(self._pages, page)
+
+    def remove(self, page, item):
+        items = self._items.get(page)
+        if items is None or item not in items:
+            return False
+        items.remove(item)
+        if not items:
+            del self._items[page]
+            del self._pages[bisect_left(self._pages, page)]
+        return True
+
+    def get(self, page):
+        return self._items.get(page, [])
+
+    def has_page(self, page):
+        return page in self._items
+
+    def pages(self):
+        return self._pages
+
+    def first_page(self):
+        if not self._pages:
+            return None
+        return self._pages[0]
+
+    def last_page(self):
+        if not self._pages:
+            return None
+        return self._pages[-1]
+
+    def prev_page(self, page, wrap=False):
+        # Closest page strictly before page
+        i = bisect_left(self._pages, page)
+        if i > 0:
+            return self._pages[i - 1]
+        if wrap:
+            return self.last_page()
+        return None
+
+    def next_page(self, page, wrap=False):
+        # Closest page strictly after page
+        i = bisect_right(self._pages, page)
+        if i < len(self._pages):
+            return self._pages[i]
+        if wrap:
+            return self.first_page()
+        return None
+
+    def floor_page(self, page):
+        # Closest page at or before page
+        i = bisect_right(self._pages, page)
+        if i > 0:
+            return self._pages[i - 1]
+        return None
+
+    def ceil_page(self, page):
+        # Closest page at or after page
+        i = bisect_left(self._pages, page)
+        if i < len(self._pages):
+            return self._pages[i]
+        return None
@@ -28,77 +28,422 @@ import simplejson
 #import cjson
 import urllib, urllib2
 import re
+import struct
+import itertools
 from xml.dom import minidom
 from sugar.datastore import datastore
 from sugar import mime
-from annobookmark import AnnoBookmark, Bookmark
+from annobookmark import AnnoBookmark, Bookmark, DETAIL_COLUMNS
+from pageindex import PageIndex
+from highlightindex import HighlightIndex
+from dbwriter import get_writer
+from annobundle import export_book, import_book
+from annosync import SyncJob, SyncCancelled, post
+from annohttp import HTTPError
+from annomerge import plan_merge
+from annostream import iter_json_array
 from sugar.graphics.xocolor import XoColor
 
 
 _logger = logging.getLogger('anno-activity')
 
+# Compare the annotation cache against the annotations table after every
+# write; slow, meant for debugging and tests only
+_VERIFY_ANNOTATION_CACHE = 'ANNO_VERIFY_CACHE' in os.environ
+
+# Number of pages whose highlights are kept in memory
+_HIGHLIGHT_CACHE_PAGES = 32
+
+# Maintenance only drops whole books once the live data in the database
+# outgrows this many bytes, and then only books not opened for
+# _RETENTION_DAYS, oldest first
+_DB_SIZE_BUDGET = 16 * 1024 * 1024
+_RETENTION_DAYS = 365
+
+# Weight of the title and content columns when ranking search hits
+_FTS_WEIGHTS = (2.0, 1.0)
+
+# Syncs normally fetch only what changed on the server since the last
+# one; every so often the whole set is fetched instead, which is what
+# lets tombstones be confirmed. Servers that number what they store
+# (seq) are asked for what came after the last number seen. Other
+# servers can only be asked by modified time, which comes from the
+# uploading client's clock, so a note written offline and uploaded late
+# can be older than the watermark; it is only found by the next full
+# fetch, which comes sooner for them.
+_FULL_SYNC_INTERVAL = 7 * 24 * 60 * 60
+_FULL_SYNC_INTERVAL_BY_MODIFIED = 24 * 60 * 60
+
+# The annotation server, unless ANNO_SERVER_URL or the gconf key say
+# otherwise; annoserver.py is a stand-in to run locally
+_DEFAULT_ANNOTATION_SERVER = 'http://anno.treehouse.su/anno/index.php'
+_ANNOTATION_SERVER_KEY = '/desktop/sugar/collaboration/annotation_server'
+
+# Annotations are uploaded this many to a request
+_UPLOAD_BATCH_SIZE = 100
+
+# Downloaded annotations are merged this many at a time, as they arrive
+_MERGE_BATCH_SIZE = 500
+
+# Server operations that failed wait in the outbox table and are tried
+# again _OUTBOX_BASE_DELAY * 2**attempts seconds later, waiting no more
+# than _OUTBOX_MAX_DELAY; the outbox is replayed this many at a time
+_OUTBOX_BASE_DELAY = 30
+_OUTBOX_MAX_DELAY = 6 * 60 * 60
+_OUTBOX_BATCH_SIZE = 100
+
+
+def _create_annotation_fts(conn):
+    # Full text index over annotation titles and bodies, keyed by
+    # annotation id and kept up to date by triggers. Older sqlite builds
+    # only have fts3, and some none at all; search() then falls back to
+    # a plain scan.
+    for module in ('fts4', 'fts3'):
+        try:
+            conn.execute('CREATE VIRTUAL TABLE IF NOT EXISTS annotations_fts USING %s (title, content)' % module)
+            break
+        except sqlite3.OperationalError, e:
+            _logger.debug('no %s support: %s', module, e)
+    else:
+        return
+    conn.execute('CREATE TRIGGER IF NOT EXISTS annotations_fts_insert AFTER INSERT ON annotations BEGIN '
+                 'INSERT INTO annotations_fts (docid, title, content) VALUES (new.id, new.title, new.content); END')
+    conn.execute('CREATE TRIGGER IF NOT EXISTS annotations_fts_delete AFTER DELETE ON annotations BEGIN '
+                 'DELETE FROM annotations_fts WHERE docid = old.id; END')
+    conn.execute('CREATE TRIGGER IF NOT EXISTS annotations_fts_update AFTER UPDATE OF title, content ON annotations BEGIN '
+                 'UPDATE annotations_fts SET title = new.title, content = new.content WHERE docid = new.id; END')
+    conn.execute('DELETE FROM annotations_fts')
+    conn.execute('INSERT INTO annotations_fts (docid, title, content) SELECT id, title, content FROM annotations')
+
+
+def _fts_rank(matchinfo):
+    # Score a hit from matchinfo()'s default 'pcx' layout: the share of
+    # each phrase's hits that fall in this row, per weighted column
+    info = struct.unpack('@%dI' % (len(matchinfo) / 4), str(matchinfo))
+    nphrases, ncols = info[0], info[1]
+    score = 0.0
+    for phrase in range(nphrases):
+        for col in range(ncols):
+            hits = info[2 + 3 * (phrase * ncols + col)]
+            if hits:
+                total = info[3 + 3 * (phrase * ncols + col)]
+                score += _FTS_WEIGHTS[col] * hits / float(total)
+    return score
+
+
+def _add_sync_seq(conn):
+    # ALTER TABLE cannot be repeated, so check first
+    columns = [row[1] for row in conn.execute('PRAGMA table_info(sync_state)')]
+    if 'remote_seq' not in columns:
+        conn.execute('ALTER TABLE sync_state ADD COLUMN remote_seq INTEGER')
+
+
+def _add_retention_tracking(conn):
+    conn.execute('CREATE TABLE IF NOT EXISTS books (md5 TEXT PRIMARY KEY, last_opened REAL)')
+    # books already in the database count as opened now, so that the
+    # first maintenance run does not drop them
+    conn.execute('INSERT OR IGNORE INTO books SELECT md5, ? FROM '
+                 '(SELECT md5 FROM annotations UNION SELECT md5 FROM highlights '
+                 'UNION SELECT md5 FROM bookmarks)', (time.time(), ))
+    # tombstones remember their book, and whether the server has been
+    # seen without the annotation, after which they can go
+    columns = [row[1] for row in conn.execute('PRAGMA table_info(deleted_annotations)')]
+    if 'md5' not in columns:
+        conn.execute('ALTER TABLE deleted_annotations ADD COLUMN md5')
+    if 'confirmed' not in columns:
+        conn.execute('ALTER TABLE deleted_annotations ADD COLUMN confirmed INTEGER DEFAULT 0')
+    conn.execute('CREATE INDEX IF NOT EXISTS deleted_annotations_md5 ON deleted_annotations (md5)')
+    # takes effect on an existing file once it has been vacuumed, which
+    # _maintain_db does at idle time rather than here on the main loop
+    conn.execute('PRAGMA auto_vacuum = INCREMENTAL')
+    conn.commit()
+
+
+def _db_live_size(conn):
+    page_size = conn.execute('PRAGMA page_size').fetchone()[0]
+    page_count = conn.execute('PRAGMA page_count').fetchone()[0]
+    free_count = conn.execute('PRAGMA freelist_count').fetchone()[0]
+    return (page_count - free_count) * page_size
+
+
+def _insert_annotations(conn, rows):
+    # On the writer thread: inserts rows whose id is None with a single
+    # executemany and returns the ids sqlite gave them. Other activity
+    # instances write to the same file, so ids can only come from the
+    # table itself. The write lock is held from the first insert until
+    # the batch commits, so each row gets max(id) + 1 and the ids are
+    # the range ending at the last one.
+    if not rows:
+        return []
+    conn.executemany('insert into annotations values (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)', rows)
+    last = conn.execute('select last_insert_rowid()').fetchone()[0]
+    return range(last - len(rows) + 1, last + 1)
+
+
+def _maintain_db(conn, size_budget, retention_days, keep):
+    # Runs on the writer thread. keep lists the books currently open.
+    conn.execute('DELETE FROM deleted_annotations WHERE confirmed=1')
+    conn.commit()
+
+    size = _db_live_size(conn)
+    if size > size_budget:
+        cutoff = time.time() - retention_days * 24 * 60 * 60
+        rows = conn.execute('SELECT md5 FROM books WHERE last_opened < ? '
+                            'ORDER BY last_opened', (cutoff, )).fetchall()
+        for row in rows:
+            md5 = row[0]
+            if md5 in keep:
+                continue
+            _logger.debug('maintenance: dropping server copies of book %s', md5)
+            # Only what the server has a copy of can be fetched again.
+            # Annotations never sent, or with changes waiting in the
+            # outbox, only exist here, as do highlights and bookmarks;
+            # tombstones keep deleted annotations from coming back.
+            conn.execute("DELETE FROM annotations WHERE md5=? AND ifnull(annotationurl, '') != '' "
+                         "AND NOT EXISTS (SELECT 1 FROM outbox WHERE op='upload' AND outbox.uuid=annotations.uuid)", (md5, ))
+            # the next sync has to fetch the dropped annotations again
+            conn.execute('DELETE FROM sync_state WHERE md5=?', (md5, ))
+            if conn.execute('SELECT (SELECT count(*) FROM annotations WHERE md5=?) + '
+                            '(SELECT count(*) FROM highlights WHERE md5=?) + '
+                            '(SELECT count(*) FROM bookmarks WHERE md5=?)',
+                            (md5, md5, md5)).fetchone()[0] == 0:
+                conn.execute('DELETE FROM books WHERE md5=?', (md5, ))
+            conn.commit()
+            size = _db_live_size(conn)
+            if size <= size_budget:
+                break
+
+    # the auto_vacuum setting only reads back once the full VACUUM that
+    # switches it on has run
+    if conn.execute('PRAGMA auto_vacuum').fetchone()[0] != 2:
+        _logger.debug('maintenance: vacuuming to enable incremental vacuum')
+        conn.execute('PRAGMA auto_vacuum = INCREMENTAL')
+        conn.commit()
+        conn.execute('VACUUM')
+    conn.execute('PRAGMA incremental_vacuum').fetchall()
+    conn.execute('PRAGMA wal_checkpoint').fetchall()
+    _logger.debug('maintenance: %d bytes of live data', size)
+
+
+# Schema upgrades, applied in order; the database's PRAGMA user_version
+# records how many of them have already run. Bundled copies of anno_v1.db
+# start at version 0. An entry is either SQL or a function taking the
+# connection.
+_MIGRATIONS = [
+    # 1: tables missing from older bundled databases
+    ['CREATE TABLE IF NOT EXISTS deleted_annotations (id INTEGER PRIMARY KEY, uuid)',
+     'CREATE TABLE IF NOT EXISTS HIGHLIGHTS (md5 TEXT, page INTEGER, init_pos INTEGER, end_pos INTEGER)'],
+    # 2: indexes for the per-book queries
+    ['DELETE FROM deleted_annotations WHERE id NOT IN (SELECT min(id) FROM deleted_annotations GROUP BY uuid)',
+     'CREATE UNIQUE INDEX IF NOT EXISTS deleted_annotations_uuid ON deleted_annotations (uuid)',
+     'CREATE INDEX IF NOT EXISTS annotations_md5_page ON annotations (md5, page)',
+     'CREATE INDEX IF NOT EXISTS annotations_uuid ON annotations (uuid)',
+     'CREATE INDEX IF NOT EXISTS highlights_md5_page ON highlights (md5, page, init_pos, end_pos)',
+     'CREATE INDEX IF NOT EXISTS bookmarks_md5_page ON bookmarks (md5, page)'],
+    # 3: full text search over annotations
+    [_create_annotation_fts],
+    # 4: book last-opened times, tombstone state, incremental vacuum
+    [_add_retention_tracking],
+    # 5: indexes for the queries across books, see annolibrary
+    ['CREATE INDEX IF NOT EXISTS annotations_creator_modified ON annotations (creator, modified)',
+     'CREATE INDEX IF NOT EXISTS annotations_modified ON annotations (modified)'],
+    # 6: per-book sync watermarks: the newest remote modified time seen,
+    # and the local times of the last full fetch and the last push
+    ['CREATE TABLE IF NOT EXISTS sync_state (md5 TEXT PRIMARY KEY, remote_modified REAL, last_full_sync REAL, last_push REAL)'],
+    # 7: deletes and uploads waiting for the server, with their retries
+    ['CREATE TABLE IF NOT EXISTS outbox (op TEXT, uuid TEXT, md5 TEXT, attempts INTEGER DEFAULT 0, next_attempt REAL DEFAULT 0, PRIMARY KEY (op, uuid))',
+     'CREATE INDEX IF NOT EXISTS outbox_md5_next_attempt ON outbox (md5, next_attempt)'],
+    # 8: the newest server sequence number seen, the sync cursor for
+    # servers that have them
+    [_add_sync_seq],
+]
+
+# The columns of an annotation summary row, in AnnoBookmark order; the
+# detail columns are left null and loaded on demand
+ANNOTATION_SUMMARY_COLUMNS = 'id, md5, page, null, null, null, null, null, ' \
+        'created, modified, creator, null, color, local, null, uuid, annotationurl'
+
+
+def _migrate_db(conn):
+    # sqlite3 commits implicitly around DDL, so every statement has to be
+    # safe to run again if an upgrade gets interrupted halfway
+    version = conn.execute('PRAGMA user_version').fetchone()[0]
+    for i in range(version, len(_MIGRATIONS)):
+        _logger.debug('upgrading annotation db to version %d', i + 1)
+        try:
+            for statement in _MIGRATIONS[i]:
+                if callable(statement):
+                    statement(conn)
+                else:
+                    conn.execute(statement)
+            conn.execute('PRAGMA user_version = %d' % (i + 1))
+            conn.commit()
+        except sqlite3.Error, e:
+            conn.rollback()
+            _logger.error('annotation db upgrade to version %d failed: %s', i + 1, e)
+            break
+
+
 def _init_db():
     dbdir = os.path.join(os.environ['SUGAR_ACTIVITY_ROOT'], 'data')
     dbpath = os.path.join(dbdir, 'anno_v1.db')
 
     srcpath = os.path.join(os.environ['SUGAR_BUNDLE_PATH'], 'anno_v1.db')
 
-    #Situation 0: Db is existent
-    if os.path.exists(dbpath):
-        conn = sqlite3.connect(dbpath)
-        conn.execute("CREATE TABLE IF NOT EXISTS deleted_annotations (id INTEGER PRIMARY KEY, uuid)")
-        conn.commit()
-        return dbpath
-
-    #Situation 1: DB is non-existent at all
     if not os.path.exists(dbpath):
         try:
             os.makedirs(dbdir)
         except:
             pass
         shutil.copy(srcpath, dbpath)
-        return dbpath
-    
-    
-    #Situation 2: DB is outdated
-    """
-    if not os.path.exists(dbpath):
-        conn = sqlite3.connect(dbpath)
 
-        conn.execute("DROP TABLE annotations")
-        conn.execute("CREATE TABLE annotations (id INTEGER PRIMARY KEY, md5, page, title, content, bodyurl, texttitle, textcreator, created TIMESTAMP, modified TIMESTAMP, creator, annotates, color, local, mimetype, uuid, annotationurl)")
-        
-        conn.execute("CREATE TABLE annuserid (username, userid)")
-        conn.commit()
+    conn = sqlite3.connect(dbpath)
+    _migrate_db(conn)
+    # Lets the main loop keep reading while the writer thread commits
+    conn.execute('PRAGMA journal_mode=WAL')
+    conn.close()
+    return dbpath
 
-        conn.close()
-        return dbpath
-    """
-    # Should not reach this point
-    return None
 
-def _init_db_highlights(conn):
-    conn.execute('CREATE TABLE IF NOT EXISTS HIGHLIGHTS ' +
-                '(md5 TEXT, page INTEGER, ' +
-                'init_pos INTEGER, end_pos INTEGER)')
-    conn.commit()
+
+def get_annotation_server():
+    """Return the url of the annotation server to sync with."""
+    url = os.environ.get('ANNO_SERVER_URL')
+    if not url:
+        url = gconf.client_get_default().get_string(_ANNOTATION_SERVER_KEY)
+    return url or _DEFAULT_ANNOTATION_SERVER
 
 
 
+_store = None
+
+def get_store():
+    """Return the process-wide annotation store, opening it on first use."""
+    global _store
+    if _store is None:
+        dbpath = _init_db()
+        assert dbpath != None
+        _store = AnnoStore(dbpath)
+    return _store
+
+
+class AnnoStore:
+    """The annotation database, shared by all managers of the process.
+
+    The schema is checked once, reads go through a single connection
+    owned by the main loop and writes through the shared writer thread.
+    Per-book views are handed out by get_book().
+    """
+    def __init__(self, dbpath):
+        self.dbpath = dbpath
+        self.conn = sqlite3.connect(dbpath, timeout=10)
+        self.conn.text_factory = lambda x: unicode(x, 'utf-8', 'ignore')
+        self.conn.execute('PRAGMA temp_store = MEMORY')
+        self.conn.execute('PRAGMA cache_size = 4000')
+        self.conn.create_function('rank', 1, _fts_rank)
+        self.writer = get_writer(dbpath)
+        self._books = {}
+        self._has_fts = self.conn.execute("select count(*) from sqlite_master "
+                "where name='annotations_fts'").fetchone()[0] > 0
+
+    def get_book(self, filehash):
+        book = self._books.get(filehash)
+        if book is None:
+            book = BookStore(self, filehash)
+            self._books[filehash] = book
+        return book
+
+    def flush(self):
+        # Returns the number of writes that have failed so far
+        return self.writer.flush()
+
+    def load_annotation_details(self, annotation):
+        # The loader for annotations read as summary rows
+        return self.conn.execute('select ' + ', '.join(DETAIL_COLUMNS) +
+                ' from annotations where id=?', (annotation.id, )).fetchone()
+
+    def schedule_maintenance(self, size_budget=_DB_SIZE_BUDGET,
+                             retention_days=_RETENTION_DAYS):
+        # Purges synced tombstones, drops stale books when over budget
+        # and returns free pages to the file system, on the writer thread
+        self.writer.call(_maintain_db, size_budget, retention_days,
+                         set(self._books.keys()))
+
+    def search(self, query, filehash=None, limit=50):
+        """Return (id, page, snippet) for the annotations matching every
+        word of query, best match first, optionally within one book."""
+        words = re.findall(r'\w+', query, re.UNICODE)
+        if not words:
+            return []
+        self.flush()
+
+        if not self._has_fts:
+            sql = 'select id, page, title from annotations where 1'
+            params = []
+            for word in words:
+                sql += ' and (title like ? or content like ?)'
+                params += ['%' + word + '%'] * 2
+            if filehash is not None:
+                sql += ' and md5=?'
+                params.append(filehash)
+            sql += ' order by modified desc limit ?'
+            params.append(limit)
+            return self.conn.execute(sql, params).fetchall()
+
+        # prefix match on every word, lowercased so that words like
+        # 'or' are not taken as operators
+        match = ' '.join([word.lower() + '*' for word in words])
+        sql = 'select a.id, a.page, snippet(annotations_fts, \'[\', \']\', \'...\') ' \
+              'from annotations_fts join annotations a on a.id = annotations_fts.docid ' \
+              'where annotations_fts match ?'
+        params = [match]
+        if filehash is not None:
+            sql += ' and a.md5=?'
+            params.append(filehash)
+        sql += ' order by rank(matchinfo(annotations_fts)) desc limit ?'
+        params.append(limit)
+        return self.conn.execute(sql, params).fetchall()
+
+
+class BookStore:
+    """The part of the annotation store that belongs to one book."""
+    def __init__(self, store, filehash):
+        self.store = store
+        self.filehash = filehash
+        self.conn = store.conn
+        self.writer = store.writer
+        self.writer.execute('insert or replace into books values (?, ?)',
+                            (filehash, time.time()))
+
+    def flush(self):
+        return self.store.flush()
+
+    def export_bundle(self, path):
+        self.flush()
+        return export_book(self.conn, self.filehash, path)
+
+    def import_bundle(self, path):
+        """Import a bundle written by export_bundle, on the writer thread,
+        and wait for it. Returns the counts of imported records."""
+        result = {}
+        self.writer.call(import_book, self.filehash, path, result)
+        self.flush()
+        if 'error' in result:
+            raise result['error']
+        return result['counts']
+
 
 
 class BookmarkManager:
     def __init__(self, filehash):
         self._filehash = filehash
 
-        dbpath = _init_db()
-
-        assert dbpath != None
+        self._book = get_store().get_book(filehash)
+        self._conn = self._book.conn
+        self._writer = self._book.writer
+        self._write_failures = self._writer.failures
 
-        self._conn = sqlite3.connect(dbpath)
-        self._conn.text_factory = lambda x: unicode(x, "utf-8", "ignore")
-
-        self._bookmarks = []
+        self._bookmark_index = PageIndex()
         self._populate_bookmarks()
         
     def add_bookmark(self, page, content, local=1):
@@ -110,10 +455,9 @@ class BookmarkManager:
         color = client.get_string("/desktop/sugar/user/color")
 
         t = (self._filehash, page, content, timestamp, user, color, local)
-        self._conn.execute('insert into bookmarks values (?, ?, ?, ?, ?, ?, ?)', t)
-        self._conn.commit()
+        self._writer.execute('insert into bookmarks values (?, ?, ?, ?, ?, ?, ?)', t)
         
-        self._resync_bookmark_cache()
+        self._bookmark_index.add(page, Bookmark(t))
        
 
 
@@ -122,10 +466,11 @@ class BookmarkManager:
         user = client.get_string("/desktop/sugar/user/nick")
 
         t = (self._filehash, page, user)
-        self._conn.execute('delete from bookmarks where md5=? and page=? and user=?', t)
-        self._conn.commit()
+        self._writer.execute('delete from bookmarks where md5=? and page=? and user=?', t)
         
-        self._resync_bookmark_cache()
+        for bookmark in list(self._bookmark_index.get(page)):
+            if bookmark.nick == user:
+                self._bookmark_index.remove(page, bookmark)
 
 
 
@@ -134,50 +479,54 @@ class BookmarkManager:
         rows = self._conn.execute('select * from bookmarks where md5=? order by page', (self._filehash,))
 
         for row in rows:
-            self._bookmarks.append(Bookmark(row))
+            self._bookmark_index.add(row[1], Bookmark(row))
+
+    def resync_bookmarks(self):
+        # To be called when bookmarks were written behind our back,
+        # e.g. by a bundle import
+        self._bookmark_index.clear()
+        self._populate_bookmarks()
             
     def get_bookmarks_for_page(self, page):
-        bookmarks = []
-        for bookmark in self._bookmarks:
-            if bookmark.belongstopage(page):
-                bookmarks.append(bookmark)
-        
-        return bookmarks
+        return list(self._bookmark_index.get(page))
     
-    def _resync_bookmark_cache(self):
-        # To be called when a new bookmark has been added/removed
-        self._bookmarks = []
-        self._populate_bookmarks()
-
 
     def get_prev_bookmark_for_page(self, page, wrap = True):
-        if not len(self._bookmarks):
+        index = self._bookmark_index
+        if not len(index):
             return None
         
-        if page <= self._bookmarks[0].page and wrap:
-            return self._bookmarks[-1]
-        else:
-            for i in range(page-1, -1, -1):
-                for bookmark in self._bookmarks:
-                    if bookmark.belongstopage(i):
-                        return bookmark
-                
-        return None 
+        if page <= index.first_page() and wrap:
+            return index.get(index.last_page())[-1]
+
+        prevpage = index.prev_page(page)
+        if prevpage is None:
+            return None
+        return index.get(prevpage)[0]
 
 
     def get_next_bookmark_for_page(self, page, wrap = True):
-        if not len(self._bookmarks):
+        index = self._bookmark_index
+        if not len(index):
             return None
         
-        if page >= self._bookmarks[-1].page and wrap:
-            return self._bookmarks[0]
-        else:
-            for i in range(page+1, self._bookmarks[-1].page + 1):
-                for bookmark in self._bookmarks:
-                    if bookmark.belongstopage(i):
-                        return bookmark
-        
-        return None       
+        if page >= index.last_page() and wrap:
+            return index.get(index.first_page())[0]
+
+        nextpage = index.next_page(page)
+        if nextpage is None:
+            return None
+        return index.get(nextpage)[0]
+
+
+    def flush(self):
+        # Wait until all queued bookmark writes are committed
+        failures = self._book.flush()
+        if failures != self._write_failures:
+            # some write failed, maybe one of ours; reread the table
+            _logger.error('bookmark writes failed, reloading the bookmarks')
+            self._write_failures = failures
+            self.resync_bookmarks()
 
 
 #/////////////////////////////////////
@@ -212,106 +561,183 @@ class AnnotationManager:
         self._id = ''
         self.modifiedtolerance = 10
         #self._annotationserver='http://localhost/anno/index.php'
-        self._annotationserver='http://anno.treehouse.su/anno/index.php'
         #self._annotationserver='http://www.andreasgros.net/wp-content/plugins/annotation/annotation.php'
+        self._annotationserver = get_annotation_server()
         self.get_etext_metadata()
-        self._to_delete = []
+        self._sync_state = None
+        self._running_sync = None
 
         self._annojson = ''
         self.remotecreators = []
         self.remotecolors = {}
+        # page -> highlight index, and the cached pages least recently
+        # used first
         self._highlights = {}
-        dbpath = _init_db()
-
-        assert dbpath != None
-
-        self._conn = sqlite3.connect(dbpath)
-
-        _init_db_highlights(self._conn)
-
-        self._conn.text_factory = lambda x: unicode(x, 'utf-8', 'ignore')
+        self._highlight_pages = []
+        # pages whose highlight writes may still be queued
+        self._dirty_highlight_pages = set()
+        self._book = get_store().get_book(filehash)
+        self._conn = self._book.conn
+        self._writer = self._book.writer
+        self._write_failures = self._writer.failures
         self._annotations = []
+        # page -> ids of the annotations on it, plus id -> annotation
+        self._annotation_index = PageIndex()
+        self._id_ann_map = {}
         self._populate_annotations()
+        # page -> number of annotations on it, for the scrollbar markers
+        self._page_counts = {}
+        self._page_counts_handler = None
+        self._count_annotation_pages()
         
   
+    def _get_highlight_index(self, page):
+        if page not in self._highlights:
+            self._load_highlights([page])
+        # mark the page as most recently used
+        self._highlight_pages.remove(page)
+        self._highlight_pages.append(page)
+        return self._highlights[page]
+
+
+
     def get_highlights(self, page):
-        try:
-            return self._highlights[page]
-        except KeyError:
-            self._highlights[page] = []
-            return self._highlights[page]
+        return self._get_highlight_index(page).ranges()
 
 
 
-    def add_highlight(self, page, highlight_tuple):
-        logging.error('Adding hg page %d %s' % (page, highlight_tuple))
-        self.get_highlights(page).append(highlight_tuple)
+    def find_highlight(self, page, selection_tuple=None, cursor_position=None):
+        # The highlight containing the selection, or else the cursor
+        index = self._get_highlight_index(page)
+        if selection_tuple:
+            found = index.find(selection_tuple[0], selection_tuple[1])
+            if found is not None:
+                return found
+        if cursor_position is not None:
+            return index.find(cursor_position)
+        return None
 
-        t = (self._filehash, page, highlight_tuple[0],
-                highlight_tuple[1])
-        self._conn.execute('insert into highlights values ' + \
+
+
+    def prefetch_highlights(self, page):
+        # Load the neighbouring pages ahead of time; returns False so it
+        # can be used as an idle callback
+        pages = [p for p in (page - 1, page + 1)
+                 if p >= 0 and p not in self._highlights]
+        if pages:
+            self._load_highlights(pages)
+        return False
+
+
+
+    def add_highlight(self, page, highlight_tuple):
+        _logger.debug('Adding hg page %d %s' % (page, highlight_tuple))
+        merged, absorbed = self._get_highlight_index(page).add(
+                highlight_tuple[0], highlight_tuple[1])
+        if absorbed == [merged]:
+            # already fully highlighted
+            return
+
+        self._writer.executemany('delete from highlights ' + \
+            'where md5=? and page=? and init_pos=? and end_pos=?', \
+            [(self._filehash, page, r[0], r[1]) for r in absorbed])
+        t = (self._filehash, page, merged[0], merged[1])
+        self._writer.execute('insert into highlights values ' + \
                 '(?, ?, ?, ?)', t)
-        self._conn.commit()
+        self._dirty_highlight_pages.add(page)
 
     def del_highlight(self, page, highlight_tuple):
-        self._highlights[page].remove(highlight_tuple)
+        self._get_highlight_index(page).remove(highlight_tuple[0],
+                highlight_tuple[1])
         t = (self._filehash, page, highlight_tuple[0], \
                 highlight_tuple[1])
-        self._conn.execute('delete from highlights ' + \
+        self._writer.execute('delete from highlights ' + \
             'where md5=? and page=? and init_pos=? and end_pos=?', \
             t)
-        self._conn.commit()
-
-    def _populate_highlights(self):
-        rows = self._conn.execute('select * from highlights ' + \
-            'where md5=? order by page', (self._filehash, ))
-        for row in rows:
-            page = row[1]
-            init_pos = row[2]
-            end_pos = row[3]
-            highlight_tuple = [init_pos, end_pos]
-            self.get_highlights(page).append(highlight_tuple)
+        self._dirty_highlight_pages.add(page)
+
+    def _load_highlights(self, pages):
+        rows = {}
+        for page in pages:
+            rows[page] = []
+        for row in self._conn.execute('select page, init_pos, end_pos ' + \
+                'from highlights where md5=? and page in (%s)' % \
+                ', '.join(['?'] * len(pages)), [self._filehash] + list(pages)):
+            rows[row[0]].append((row[1], row[2]))
+
+        for page in pages:
+            index = HighlightIndex(rows[page])
+            if page in self._highlights:
+                self._highlight_pages.remove(page)
+            self._highlights[page] = index
+            self._highlight_pages.append(page)
+            if len(index) < len(rows[page]):
+                # Overlapping rows saved by older versions; store the
+                # merged ranges instead
+                self._writer.execute('delete from highlights ' + \
+                    'where md5=? and page=?', (self._filehash, page))
+                self._writer.executemany('insert into highlights ' + \
+                    'values (?, ?, ?, ?)', [(self._filehash, page, r[0], r[1])
+                    for r in index.ranges()])
+                self._dirty_highlight_pages.add(page)
+
+        while len(self._highlight_pages) > _HIGHLIGHT_CACHE_PAGES:
+            page = self._highlight_pages.pop(0)
+            del self._highlights[page]
+            if page in self._dirty_highlight_pages:
+                # the page could be read back before its writes are
+                # committed, so commit them now; failed writes are left
+                # for flush() to deal with
+                self._book.flush()
+                self._dirty_highlight_pages.clear()
 
 
     def get_userid_for_username(self, user):
-        needsupdate = False
-        needsinsert = False
-        userid = ''
-        rows = self._conn.execute('select userid from annuserid where username=?', (user, ))
-        if ( rows != None ):
-            r = rows.fetchone()
-            if ( r != None ):
-                if ( len(r[0]) > 0 ):
-                    userid = r[0]
-                else:
-                    needsupdate = True
-            else:
-                needsinsert = True
-        if ( rows == None ) or needsupdate or needsinsert:  
-            url = self._annotationserver
-            values = {'getidforuser' : user}
-            try:
-                data = urllib.urlencode(values)          
-                req = urllib2.Request(url, data)
-                response = urllib2.urlopen(req)
-                jsonstr = response.read()
-                _logger.debug("\n\ngot this userid json %s\n\n" % jsonstr )
-                json_arr = simplejson.loads( jsonstr ) 
-                _logger.debug("userid - json_arr %s" % json_arr )
-                userid = json_arr['userid']
-                _logger.debug("\nuserid is %s\n\n" % userid)
-            except Exception, detail: 
-                _logger.debug("userid fetching failed; detail: %s ", detail)
-            if not needsupdate or needsinsert:
-                _logger.debug('insert user, userid %s', str((user, userid)))
-                self._conn.execute( 'insert into annuserid values (?, ?)', (user, userid) ) 
-            else:               
-                _logger.debug('updating userid %s', userid)
-                self._conn.execute( 'update annuserid set userid=? where username=?', ( userid, user ) )
-            self._conn.commit()
+        userid, known = self._lookup_userid(user)
+        if not userid:
+            userid = self._fetch_userid(user)
+            self._store_userid(user, userid, known)
         _logger.debug('userid: found %s', userid)
         return userid
 
+
+
+    def _lookup_userid(self, user):
+        # Returns the stored userid, or '', and whether user has a row
+        rows = self._conn.execute('select userid from annuserid where username=?', (user, ))
+        r = rows.fetchone()
+        if ( r != None ):
+            return r[0] or '', True
+        return '', False
+
+
+
+    def _fetch_userid(self, user):
+        # Network only, so that the sync worker can call it
+        url = self._annotationserver
+        values = {'getidforuser' : user}
+        userid = ''
+        try:
+            jsonstr = post(url, urllib.urlencode(values))
+            _logger.debug("\n\ngot this userid json %s\n\n" % jsonstr )
+            json_arr = simplejson.loads( jsonstr ) 
+            _logger.debug("userid - json_arr %s" % json_arr )
+            userid = json_arr['userid']
+            _logger.debug("\nuserid is %s\n\n" % userid)
+        except Exception, detail: 
+            _logger.debug("userid fetching failed; detail: %s ", detail)
+        return userid
+
+
+
+    def _store_userid(self, user, userid, known):
+        if not known:
+            _logger.debug('insert user, userid %s', str((user, userid)))
+            self._writer.execute( 'insert into annuserid values (?, ?)', (user, userid) ) 
+        else:               
+            _logger.debug('updating userid %s', userid)
+            self._writer.execute( 'update annuserid set userid=? where username=?', ( userid, user ) )
+
         
     def add_annotation(self, page, content, local=1):
         # locale = 0 means that this is a bookmark originally 
@@ -332,24 +758,17 @@ class AnnotationManager:
         self._content = note['body']
         self._creator = self._userid
 
-        #check the last id from the database store
-        row = self._conn.execute('select id from annotations order by id desc limit 1')
-        aid = 0
-        r = row.fetchone() 
-        if r != None:
-            aid = int(r[0]) + 1
-
         #(id INTEGER PRIMARY KEY, md5, page, title, content, bodyurl, texttitle, textcreator, created TIMESTAMP, modified TIMESTAMP, creator, annotates, color, local, mimetype, uuid, annotationurl)
-        t = (aid, self._filehash, page, self._annotitle, self._content, self._bodyurl, self._texttitle, self._textcreator, self._created, self._modified, self._userid, self._annotates, self._color, self._local, self._mimetype, None, None)
+        t = (None, self._filehash, page, self._annotitle, self._content, self._bodyurl, self._texttitle, self._textcreator, self._created, self._modified, self._userid, self._annotates, self._color, self._local, self._mimetype, None, None)
         annotation = AnnoBookmark(t)
+        self._insert_annotations([annotation])
 
         self._annojson = annotation.get_json()
-        #(id INTEGER PRIMARY KEY, md5, page, title, content, bodyurl, texttitle, textcreator, created TIMESTAMP, modified TIMESTAMP, creator, annotates, color, local, mimetype, uuid, annotationurl)
-        t = (aid, self._filehash, page, self._annotitle, self._content, self._bodyurl, self._texttitle, self._textcreator,  self._created, self._modified, self._creator, self._annotates, self._color, self._local, self._mimetype, annotation.get_uuid(), None)
-        self._conn.execute('insert into annotations values (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)', t)
-        self._conn.commit()
-        self._resync_annotation_cache()
-        self.current_annotation = self._annotations[-1]
+        self._cache_annotation(annotation)
+        self.current_annotation = annotation
+        self._add_page_count(page, 1)
+        self._page_counts_changed()
+        self._check_annotation_cache()
        
 
 
@@ -363,14 +782,14 @@ class AnnotationManager:
         annotitle = note['title']
         annocontent = note['body']
 
-        for a in self._annotations:
-            if a.get_id() == annotation_id:
-                if ( a.get_note_title() != annotitle ) or ( a.get_note_body() != annocontent ):
-                    a.set_modified(time.time())
-                    a.set_note_title(annotitle)
-                    a.set_note_body(annocontent)
-                    self.update_annotation_db_record(a)
-                    break
+        a = self._id_ann_map.get(annotation_id)
+        if a is not None:
+            if ( a.get_note_title() != annotitle ) or ( a.get_note_body() != annocontent ):
+                a.set_modified(time.time())
+                a.set_note_title(annotitle)
+                a.set_note_body(annocontent)
+                self.update_annotation_db_record(a)
+                self._check_annotation_cache()
         
 
 
@@ -383,19 +802,24 @@ class AnnotationManager:
         #get the clientuuid to schedule its deletion on the annotation server
         _logger.debug('delete annotation with id %s', str(annotation_id) )
 
-        rows = self._conn.execute('select uuid, creator from annotations where md5=? and id=?', [self._filehash, annotation_id])
-        row = rows.fetchone()
-        if row[1] == self._userid:
-            self._to_delete.append(row[0])
-            _logger.debug(str('schedule annotation %s for deletion' % str(row)))
+        annotation = self._id_ann_map.get(annotation_id)
+        if annotation is None:
+            _logger.debug('annotation %s is not cached', str(annotation_id))
+            return
+        if annotation.get_creator() == self._userid:
+            # the server hears of it when the outbox is next replayed
+            self._writer.execute("delete from outbox where op='upload' and uuid=?", (annotation.get_uuid(), ))
+            self._writer.execute("insert or ignore into outbox (op, uuid, md5) values ('delete', ?, ?)", (annotation.get_uuid(), self._filehash))
+            _logger.debug('schedule annotation %s for deletion', annotation.get_uuid())
         else:
-            self._conn.execute('insert into deleted_annotations values (?, ?)', (None, row[0]))
+            self._writer.execute('insert or ignore into deleted_annotations (uuid, md5) values (?, ?)', (annotation.get_uuid(), self._filehash))
         t = (self._filehash, annotation_id)
         _logger.debug(str('t for deletion is %s' % str(t)))
-        self._conn.execute('delete from annotations where md5=? and id=?', t)
-        check = self._conn.commit()
-        _logger.debug('deletion check %s ', str(check))
-        self._resync_annotation_cache()
+        self._writer.execute('delete from annotations where md5=? and id=?', t)
+        self._uncache_annotation(annotation)
+        self._add_page_count(annotation.page, -1)
+        self._page_counts_changed()
+        self._check_annotation_cache()
 
 
 
@@ -403,132 +827,269 @@ class AnnotationManager:
     def _populate_annotations(self):
         # TODO: Figure out if caching the entire set of annotations is a good idea or not
         #(id INTEGER PRIMARY KEY, md5, page, title, content, bodyurl, texttitle, textcreator, created TIMESTAMP, modified TIMESTAMP, creator, annotates, color, local, mimetype, uuid, annotationurl)
-        rows = self._conn.execute('select id, md5, page, title, content, bodyurl, texttitle, textcreator, created, modified, creator, annotates, color, local, mimetype, uuid, annotationurl from annotations where md5=? order by page', [self._filehash])
+        # Only the summary columns are read here; the detail columns, the
+        # bulk of each row, are fetched per annotation when first used
+        rows = self._conn.execute('select ' + ANNOTATION_SUMMARY_COLUMNS + ' from annotations where md5=? order by page', [self._filehash])
+        loader = self._book.store.load_annotation_details
+        for row in rows:
+            self._cache_annotation(AnnoBookmark(row, loader))
+
+
+
+    def _cache_annotation(self, annotation):
+        self._annotations.append(annotation)
+        self._id_ann_map[annotation.id] = annotation
+        self._annotation_index.add(annotation.page, annotation.id)
+
+
+
+    def _uncache_annotation(self, annotation):
+        self._annotations.remove(annotation)
+        del self._id_ann_map[annotation.id]
+        self._annotation_index.remove(annotation.page, annotation.id)
+        if self.current_annotation is annotation:
+            self.current_annotation = None
+
+
+
+    def verify_annotation_cache(self):
+        # Returns a list describing every difference between the cache
+        # and the annotations table; empty when they agree
+        problems = []
+        self._book.flush()
+        fields = ('page', 'title', 'content', 'bodyurl', 'modified', 'creator', 'uuid', 'annotationurl')
+        rows = self._conn.execute('select id, ' + ', '.join(fields) + ' from annotations where md5=?', (self._filehash, ))
+        dbids = set()
         for row in rows:
-            self._annotations.append(AnnoBookmark(row))
-            _logger.debug('picked %s', self._annotations[-1].get_note_body())
-            _logger.debug('row content %s', row[4])
+            dbids.add(row[0])
+            a = self._id_ann_map.get(row[0])
+            if a is None:
+                problems.append('annotation %s is not cached' % row[0])
+                continue
+            for i, field in enumerate(fields):
+                value = getattr(a, field)
+                if value != row[i + 1] and (value or row[i + 1]):
+                    problems.append('annotation %s: %s is %r in cache, %r in db' % (row[0], field, value, row[i + 1]))
+        for aid in self._id_ann_map.keys():
+            if aid not in dbids:
+                problems.append('annotation %s is cached but not in db' % aid)
+        if len(self._annotations) != len(self._id_ann_map):
+            problems.append('annotation list and id map differ in size')
+        indexed = 0
+        for page in self._annotation_index.pages():
+            for aid in self._annotation_index.get(page):
+                indexed += 1
+                a = self._id_ann_map.get(aid)
+                if a is None or a.page != page:
+                    problems.append('annotation %s is indexed under the wrong page %s' % (aid, page))
+            if self._page_counts.get(page) != len(self._annotation_index.get(page)):
+                problems.append('page %s counts %s annotations, index %d' % (page, self._page_counts.get(page), len(self._annotation_index.get(page))))
+        if indexed != len(self._id_ann_map):
+            problems.append('page index holds %d ids, cache %d' % (indexed, len(self._id_ann_map)))
+        if len(self._page_counts) != len(self._annotation_index):
+            problems.append('%d pages counted, %d indexed' % (len(self._page_counts), len(self._annotation_index)))
+        return problems
+
+
+
+    def _check_annotation_cache(self):
+        if not _VERIFY_ANNOTATION_CACHE:
+            return
+        for problem in self.verify_annotation_cache():
+            _logger.error('annotation cache: %s', problem)
+
+
+
+
+    def flush(self):
+        # Wait until all queued annotation and highlight writes are committed
+        failures = self._book.flush()
+        self._dirty_highlight_pages.clear()
+        if failures != self._write_failures:
+            # some write failed, maybe one of ours; reread the tables
+            _logger.error('annotation writes failed, reloading the annotations')
+            self._write_failures = failures
+            self._highlights.clear()
+            del self._highlight_pages[:]
+            self._resync_annotation_cache()
+
+
+
+    def export_bundle(self, path):
+        # Writes this book's annotations, highlights and bookmarks to path
+        return self._book.export_bundle(path)
+
+
+
+    def import_bundle(self, path):
+        """Merge the bundle at path into this book; annotations already
+        known by uuid are skipped. Bookmark managers for the book need a
+        resync_bookmarks() afterwards."""
+        counts = self._book.import_bundle(path)
+        self._dirty_highlight_pages.clear()
+        self._highlights.clear()
+        del self._highlight_pages[:]
+        self._resync_annotation_cache()
+        self._check_annotation_cache()
+        return counts
+
+
+
+
+    def search(self, query, book_only=True):
+        # Ranked (id, page, snippet) hits from the full text index
+        if book_only:
+            return self._book.store.search(query, self._filehash)
+        return self._book.store.search(query)
 
 
 
 
     def get_annotations_for_page(self, page):
-        annotations = []
-        for annotation in self._annotations:
-            if annotation.belongstopage(page):
-                annotations.append(annotation)
-        return annotations
+        return [self._id_ann_map[aid] for aid in self._annotation_index.get(page)]
   
 
 
     def _resync_annotation_cache(self):
         # To be called when a new bookmark has been added/removed
         self._annotations = []
+        self._annotation_index.clear()
+        self._id_ann_map = {}
         self._populate_annotations()
+        self._count_annotation_pages()
+        self._page_counts_changed()
+
+
+
+    def _count_annotation_pages(self):
+        # One pass over the (md5, page) index; kept up to date by
+        # _add_page_count afterwards
+        rows = self._conn.execute('select page, count(*) from annotations where md5=? group by page', (self._filehash, ))
+        self._page_counts = dict(rows.fetchall())
+
+
+
+    def _add_page_count(self, page, delta):
+        count = self._page_counts.get(page, 0) + delta
+        if count > 0:
+            self._page_counts[page] = count
+        else:
+            self._page_counts.pop(page, None)
+
+
+
+    def _page_counts_changed(self):
+        if self._page_counts_handler is not None:
+            self._page_counts_handler(self._page_counts)
+
+
+
+    def get_page_counts(self):
+        # page -> number of annotations, for the pages that have any
+        return self._page_counts
+
+
+
+    def connect_page_counts_handler(self, handler):
+        # handler(page_counts) is called whenever annotations are added
+        # or removed
+        self._page_counts_handler = handler
 
 
 
     def get_pages_and_id_to_ann_map(self):
         pages = {}
-        id_ann_map = {}
-        if len(self._annotations) == 0:
-            self._populate_annotations()
-        for a in self._annotations:
-            id_ann_map[a.id] = a
-            if a.page in pages.keys():
-                pages[a.page].append(a.id)
-            else:
-                pages[a.page] = [a.id]
-                
-        return pages, id_ann_map
+        for page in self._annotation_index.pages():
+            pages[page] = list(self._annotation_index.get(page))
+        return pages, self._id_ann_map
 
 
 
+    def _get_current_annotation(self):
+        # current_annotation may point to an annotation that has been
+        # deleted or replaced since it was selected
+        annotation = self.current_annotation
+        if annotation is not None and \
+                self._id_ann_map.get(annotation.id) is annotation:
+            return annotation
+        return None
+
+
 
     def get_prev_annotation(self, page):
-        pages, id_ann_map = self.get_pages_and_id_to_ann_map()
-        pages_with_annotations = sorted(pages.keys())
-        if not pages_with_annotations == None:
-            if self.current_annotation == None: 
-                if not page in pages_with_annotations:
-                    prevpages = [p for p in pages_with_annotations if p <= page]
-                    if len(prevpages) > 0:
-                        page = prevpages[-1]
-                    else:
-                        if len(pages_with_annotations) > 0:
-                            page = pages_with_annotations[-1]
-                if page in pages.keys():
-                    self.current_annotation = id_ann_map[pages[page][0]]
-            if not self.current_annotation == None: 
-                t = pages[self.current_annotation.page]
-                tind = t.index(self.current_annotation.id)
-                if tind > 0: #prev annotation on the same page
-                    self.current_annotation = id_ann_map[t[tind - 1]]
-                else:    
-                    self.current_annotation = id_ann_map[pages[pages_with_annotations[( pages_with_annotations.index(self.current_annotation.page) - 1 ) % len(pages_with_annotations)]][-1]]
-                return self.current_annotation
-        return None
+        index = self._annotation_index
+        if not len(index):
+            return None
+        current = self._get_current_annotation()
+        if current is None:
+            if not index.has_page(page):
+                page = index.floor_page(page)
+                if page is None:
+                    page = index.last_page()
+            current = self._id_ann_map[index.get(page)[0]]
+        ids = index.get(current.page)
+        ind = ids.index(current.id)
+        if ind > 0: #prev annotation on the same page
+            self.current_annotation = self._id_ann_map[ids[ind - 1]]
+        else:
+            prevpage = index.prev_page(current.page, wrap=True)
+            self.current_annotation = self._id_ann_map[index.get(prevpage)[-1]]
+        return self.current_annotation
 
 
 
 
     def get_next_annotation(self, page):
-        pages, id_ann_map = self.get_pages_and_id_to_ann_map()
-        pages_with_annotations = sorted(pages.keys())
-        if not pages_with_annotations == None:
-            if self.current_annotation == None: 
-                if not page in pages_with_annotations:
-                    nextpages = [p for p in pages_with_annotations if p >= page]
-                    if len(nextpages) > 0:
-                        page = nextpages[0]
-                    else:
-                        if len(pages_with_annotations) > 0:
-                            page = pages_with_annotations[0]
-                if page in pages.keys(): 
-                    self.current_annotation = id_ann_map[pages[page][0]]
-            if not self.current_annotation == None: 
-                t = pages[self.current_annotation.page]
-                tind = t.index(self.current_annotation.id)
-                if tind < len(t) - 1: #next annotation on the same page
-                    self.current_annotation = id_ann_map[t[tind + 1]]
-                else:    
-                    self.current_annotation = id_ann_map[pages[pages_with_annotations[( pages_with_annotations.index(self.current_annotation.page) + 1 ) % len(pages_with_annotations)]][0]]
-                return self.current_annotation
-        return None
+        index = self._annotation_index
+        if not len(index):
+            return None
+        current = self._get_current_annotation()
+        if current is None:
+            if not index.has_page(page):
+                page = index.ceil_page(page)
+                if page is None:
+                    page = index.first_page()
+            current = self._id_ann_map[index.get(page)[0]]
+        ids = index.get(current.page)
+        ind = ids.index(current.id)
+        if ind < len(ids) - 1: #next annotation on the same page
+            self.current_annotation = self._id_ann_map[ids[ind + 1]]
+        else:
+            nextpage = index.next_page(current.page, wrap=True)
+            self.current_annotation = self._id_ann_map[index.get(nextpage)[0]]
+        return self.current_annotation
 
 
                           
 
 
     def get_prev_annotation_for_page(self, page, wrap = True):
-        if not len(self._annotations):
+        index = self._annotation_index
+        if not len(index):
             return None
         
-        if page <= self._annotations[0].page and wrap:
-            return self._annotations[-1]
-        else:
-            for i in range(page-1, -1, -1):
-                for annotation in self._annotations:
-                    if annotation.belongstopage(i):
-                        return annotation
-                
-        return None 
+        if page <= index.first_page() and wrap:
+            return self._id_ann_map[index.get(index.last_page())[-1]]
+
+        prevpage = index.prev_page(page)
+        if prevpage is None:
+            return None
+        return self._id_ann_map[index.get(prevpage)[0]]
 
 
 
     def get_next_annotation_for_page(self, page, wrap = True):
-        if not len(self._annotations):
+        index = self._annotation_index
+        if not len(index):
             return None
 
-        if page >= self._annotations[-1].page and wrap:
-            return self._annotations[0]
-        else:
-            for i in range(page+1, self._annotations[-1].page + 1):
-                for annotation in self._annotations:
-                    if annotation.belongstopage(i):
-                        return annotation
+        if page >= index.last_page() and wrap:
+            return self._id_ann_map[index.get(index.first_page())[0]]
 
-        return None    
+        nextpage = index.next_page(page)
+        if nextpage is None:
+            return None
+        return self._id_ann_map[index.get(nextpage)[0]]
 
 
 
@@ -551,13 +1112,32 @@ class AnnotationManager:
     def parse_annotations(self, json):
         annoarr = simplejson.loads(json)
         #annoarr = cjson.decode(json)
-        remote_annotations = []
+        return [self._remote_annotation(a) for a in annoarr]
+
+
+
+    def _remote_annotation(self, a):
         #(id INTEGER PRIMARY KEY, md5, page, title, content, bodyurl, texttitle, textcreator, created TIMESTAMP, modified TIMESTAMP, creator, annotates, color, local, mimetype, uuid, annotationurl)
-        for a in annoarr:
-            t = (a['id'], a['md5'], a['page'], a['title'], a['content'], a['bodyurl'], a['texttitle'], a['textcreator'], a['created'], a['modified'], a['creator'], a['annotates'], a['color'], a['local'], a['mimetype'], a['uuid'], a['annotationurl'])
-            remote_annotations.append(AnnoBookmark(t))
+        t = (a['id'], a['md5'], a['page'], a['title'], a['content'], a['bodyurl'], a['texttitle'], a['textcreator'], a['created'], a['modified'], a['creator'], a['annotates'], a['color'], a['local'], a['mimetype'], a['uuid'], a['annotationurl'])
+        return AnnoBookmark(t)
+
 
-        return remote_annotations
+
+    def _iter_remote_batches(self, chunks, newest=None):
+        # Runs on the sync worker: the annotations of a server answer,
+        # parsed as its text arrives and handed out in batches. newest,
+        # if given, is a [modified, seq] list kept at the newest values
+        # of the answer.
+        batch = []
+        for a in iter_json_array(chunks):
+            if newest is not None:
+                self._note_newest(a, newest)
+            batch.append(self._remote_annotation(a))
+            if len(batch) >= _MERGE_BATCH_SIZE:
+                yield batch
+                batch = []
+        if batch:
+            yield batch
 
 
 
@@ -591,17 +1171,49 @@ class AnnotationManager:
 
 
 
-    def insert_annotation_db_record(self, annotation):
+    def _annotation_db_row(self, annotation):
         #(id INTEGER PRIMARY KEY, md5, page, title, content, bodyurl, texttitle, textcreator, created TIMESTAMP, modified TIMESTAMP, creator, annotates, color, local, mimetype, uuid, annotationurl)
-        t = (None, annotation.get_filehash(), annotation.get_page(), annotation.get_note_title(), annotation.get_note_body(), annotation.get_bodyurl(), annotation.get_texttitle(), annotation.get_textcreator(), annotation.get_created(), annotation.get_modified(), annotation.get_creator(), annotation.get_annotates(), annotation.get_color().to_string(), annotation.is_local(), annotation.get_mimetype(), annotation.get_uuid(), annotation.get_annotationurl())
-        self._conn.execute('insert into annotations values (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)', t)
-        self._conn.commit()
-        row = self._conn.execute('select id from annotations order by id desc limit 1')
-        r = row.fetchone() 
-        tid = int( r[0] )
-        annotation.set_id( tid )
+        return (annotation.get_id(), annotation.get_filehash(), annotation.get_page(), annotation.get_note_title(), annotation.get_note_body(), annotation.get_bodyurl(), annotation.get_texttitle(), annotation.get_textcreator(), annotation.get_created(), annotation.get_modified(), annotation.get_creator(), annotation.get_annotates(), annotation.get_color().to_string(), annotation.is_local(), annotation.get_mimetype(), annotation.get_uuid(), annotation.get_annotationurl())
+
+
+    def insert_annotation_db_record(self, annotation):
+        self._insert_annotations([annotation])
         self.current_annotation = annotation
 
+
+    def _insert_annotations(self, annotations):
+        # Inserts on the writer thread and waits for the ids sqlite gives
+        # the rows; an annotation without a uuid gets one made from its id
+        for annotation in annotations:
+            annotation.set_id(None)
+        ids = self._writer.call_and_wait(_insert_annotations,
+                [self._annotation_db_row(a) for a in annotations])
+        uuids = []
+        for annotation, aid in zip(annotations, ids):
+            annotation.set_id(aid)
+            if not annotation.get_uuid():
+                annotation.make_new_uuid()
+                uuids.append((annotation.get_uuid(), aid))
+        if uuids:
+            self._writer.executemany('update annotations set uuid=? where id=?', uuids)
+
+
+    def import_annotations(self, annotations, uuid_map=None):
+        # Stores a batch of annotations, e.g. a download, in one writer
+        # transaction, and caches them under the ids sqlite gave them.
+        # A uuid map kept across the batches of a download is updated
+        # with the new annotations.
+        if not annotations:
+            return
+        self._insert_annotations(annotations)
+        for annotation in annotations:
+            self._cache_annotation(annotation)
+            self._add_page_count(annotation.page, 1)
+            if uuid_map is not None:
+                uuid_map[annotation.get_uuid()] = annotation
+        self.current_annotation = annotations[-1]
+        self._page_counts_changed()
+
     
     def update_annotation_db_record(self, annotation):
         #if a user changes a annotation, it becomes her own
@@ -611,13 +1223,16 @@ class AnnotationManager:
             self._userid = self.get_userid_for_username( self.get_user_string( user ) )
         annotation.set_creator( self._userid )
         annotation.make_new_uuid()
-        #(id INTEGER PRIMARY KEY, md5, page, title, content, bodyurl, texttitle, textcreator, created TIMESTAMP, modified TIMESTAMP, creator, annotates, color, local, mimetype, uuid, annotationurl)
-        t = (annotation.get_filehash(), annotation.get_page(), annotation.get_note_title(), annotation.get_note_body(), annotation.get_bodyurl(), annotation.get_texttitle(),  annotation.get_textcreator(), annotation.get_created(), annotation.get_modified(), self._userid, annotation.get_annotates(), annotation.get_color().to_string(), annotation.is_local(), annotation.get_mimetype(), annotation.get_uuid(), annotation.get_annotationurl(), annotation.get_id())
-        self._conn.execute('update annotations set md5=?,  page=?,  title=?,  content=?,  bodyurl=?, texttitle=?, textcreator=?, created=?,  modified=?,  creator=?,  annotates=?, color=?,  local=?,  mimetype=?,  uuid=?,  annotationurl=? where id=?', t)
-        self._conn.commit()
+        self._write_annotation_db_record(annotation)
         self.current_annotation = annotation
 
 
+    def _write_annotation_db_record(self, annotation):
+        #(id INTEGER PRIMARY KEY, md5, page, title, content, bodyurl, texttitle, textcreator, created TIMESTAMP, modified TIMESTAMP, creator, annotates, color, local, mimetype, uuid, annotationurl)
+        t = (annotation.get_filehash(), annotation.get_page(), annotation.get_note_title(), annotation.get_note_body(), annotation.get_bodyurl(), annotation.get_texttitle(),  annotation.get_textcreator(), annotation.get_created(), annotation.get_modified(), annotation.get_creator(), annotation.get_annotates(), annotation.get_color().to_string(), annotation.is_local(), annotation.get_mimetype(), annotation.get_uuid(), annotation.get_annotationurl(), annotation.get_id())
+        self._writer.execute('update annotations set md5=?,  page=?,  title=?,  content=?,  bodyurl=?, texttitle=?, textcreator=?, created=?,  modified=?,  creator=?,  annotates=?, color=?,  local=?,  mimetype=?,  uuid=?,  annotationurl=? where id=?', t)
+
+
     def makeDateTimeFromTimeStamp(self, tstamp):
         return time.strftime("%Y-%m-%d %H:%M:%S",time.localtime(tstamp))
 
@@ -626,63 +1241,215 @@ class AnnotationManager:
         return time.mktime(time.strptime(datetimestr, "%Y-%m-%d %H:%M:%S"))
 
 
-    def download_annotations(self):
-        url = self._annotationserver
-        annotations = []
-        annojson = ""
+    def download_annotations(self, done_cb=None, progress_cb=None):
+        # The exchange with the server runs on a worker thread, see
+        # annosync; returns the SyncJob, or None if a sync is running
+        return self._start_sync_job(self._download_job, done_cb, progress_cb)
+
+
+
+    def sync_annotations(self, done_cb=None, progress_cb=None):
+        return self._start_sync_job(self._sync_job, done_cb, progress_cb)
+
+
+
+    def drain_outbox(self, done_cb=None):
+        # Replays the outbox on the sync worker if anything in it is due;
+        # returns the SyncJob, or None
+        self._book.flush()
+        row = self._conn.execute('select 1 from outbox where md5=? and next_attempt<=? limit 1', (self._filehash, time.time())).fetchone()
+        if row is None:
+            return None
+        return self._start_sync_job(self._drain_job, done_cb, None)
+
+
+
+    def cancel_sync(self):
+        if self._running_sync is not None:
+            self._running_sync.cancel()
+
+
+
+    def is_syncing(self):
+        return self._running_sync is not None
+
+
+
+    def _start_sync_job(self, job, done_cb, progress_cb):
+        if self._running_sync is not None:
+            _logger.debug('annotation sync already running')
+            return None
+
+        def job_done_cb(error):
+            self._running_sync = None
+            self._check_annotation_cache()
+            if done_cb is not None:
+                done_cb(error)
+            return False
+
+        self._running_sync = SyncJob(job, job_done_cb, progress_cb)
+        self._running_sync.start()
+        return self._running_sync
+
+
+
+    def _download_job(self, job):
+        # Runs on the sync worker; each yield runs a step on the main loop
+        self._replay_outbox(job)
+        url, data, full, deleted_annotations, uuid_map = yield (self._prepare_download, ())
+        job.progress('fetch', 0, 1)
+        # the answer is merged a batch at a time while it downloads
+        response = post(url, data, stream=True)
+        seen = set()
+        newest = [None, None]
+        payloads = []
+        try:
+            first = response.read()
+            if not first:
+                return
+            for anno_arr in self._iter_remote_batches(itertools.chain([first], response), newest):
+                payloads += yield (self._merge_download, (anno_arr, deleted_annotations, seen, uuid_map))
+        finally:
+            response.close()
+        job.progress('fetch', 1, 1)
+        yield (self._finish_download, (seen, newest, full))
+        if payloads:
+            urls, ok = self._upload_annotations(job, payloads)
+            yield (self._finish_upload, (payloads, urls))
+
+
+
+    def _prepare_download(self):
+        self._book.flush()
         deleted_annotations_arr = self._conn.execute('select uuid from deleted_annotations')
-        deleted_annotations = [ r[0] for r in deleted_annotations_arr]
+        deleted_annotations = set([ r[0] for r in deleted_annotations_arr])
+        # nor bring back annotations whose deletion is still on its way
+        deleted_annotations.update([r[0] for r in self._conn.execute("select uuid from outbox where op='delete'")])
         values = {'checksum' : self._filehash}
+        full = self._add_sync_watermark(values)
+        self.remotecreators = []
+        self.remotecolors = {}
         _logger.debug('download annotations -- annotates is: %s ' % self._annotates)
-        try:
-            data = urllib.urlencode(values)          
-            req = urllib2.Request(url, data)
-            response = urllib2.urlopen(req)
-            annojson = response.read() 
-        except Exception, detail: 
-            _logger.debug("readdb: failure at initial sync request f. annotations; detail: %s ", detail) 
-
-        _logger.debug('annojson is: %s', str(annojson))
-        if (annojson != None) and (len(annojson) > 0):    
-            anno_arr = self.parse_annotations(annojson)  
-            _logger.debug('length anno_arr %d', len(anno_arr))
-            remote_uuids = []
-            if len(anno_arr) > 0:
-                remote_uuids = [a.get_uuid() for a in anno_arr]
-                _logger.debug('remote_uuids %s', remote_uuids)
-                #check the modified timestamps
-                localuuids = [la.get_uuid() for la in self._annotations]
-                self.remotecreators = []
-                self.remotecolors = {}
-                for a in anno_arr:
-                    uuid = a.get_uuid()
-                    if not uuid in deleted_annotations:
-                        if uuid in localuuids:
-                            _logger.debug('uuid exists locally')
-                            ind = localuuids.index(uuid)
-                            rmodifiedtstamp = a.get_modified()
-                            _logger.debug(str('timestamps are remote: %d, local %d' % (rmodifiedtstamp, self._annotations[ind].get_modified())))
-                            if self._annotations[ind].get_modified() < rmodifiedtstamp - self.modifiedtolerance:
-                                _logger.debug('remote annotation is more recent than local annotation')
-                                #take over the content
-                                self._annotations[ind].set_note_title(a.get_note_title())
-                                self._annotations[ind].set_note_body(a.get_note_body())
-                                self._annotations[ind].set_modified(rmodifiedtstamp) 
-                                self.update_annotation_db_record(a)
-                                _logger.debug(str('after update: timestamps are remote: %d, local %d' % (rmodifiedtstamp, self._annotations[ind].get_modified())))
-                            else:
-                                if self._annotations[ind].get_creator() == self._creator:
-                                    _logger.debug(str('remote annotation is outdated, sending %s' % self._annotations[ind]))
-                                    self.send_annotation_to_server(self._annotations[ind]) 
-                        else:  
-                            remotecreator = a.get_creator()
-                            if not remotecreator in self.remotecreators:
-                                self.remotecreators.append(remotecreator)
-                                self.remotecolors[remotecreator] = XoColor()
-                                a.color = self.remotecolors[remotecreator]
-                            self.insert_annotation_db_record(a)
-                            self._annotations.append(a)
-                            self._sidebar.update_for_page(a.page)
+        # built once for the whole download; the batches keep it current
+        uuid_map = self._get_uuid_ann_map()
+        return self._annotationserver, urllib.urlencode(values), full, deleted_annotations, uuid_map
+
+
+
+    def _merge_download(self, anno_arr, deleted_annotations, seen, uuid_map):
+        # Merges a batch of the download. Returns the upload payloads of
+        # the local annotations that are newer than the server's copy.
+        _logger.debug('length anno_arr %d', len(anno_arr))
+        plan = plan_merge(uuid_map, anno_arr,
+                          deleted_annotations, self._creator,
+                          self.modifiedtolerance, seen=seen)
+        _logger.debug('merge plan: %d new, %d updated, %d to send, %d skipped', len(plan.insert), len(plan.update_local), len(plan.push_remote), len(plan.skip))
+        self._take_over_remote_content(plan.update_local)
+
+        for a in plan.insert:
+            remotecreator = a.get_creator()
+            if not remotecreator in self.remotecreators:
+                self.remotecreators.append(remotecreator)
+                self.remotecolors[remotecreator] = XoColor()
+                a.color = self.remotecolors[remotecreator]
+        if len(plan.insert) > 0:
+            self.import_annotations(plan.insert, uuid_map)
+            self._sidebar.update_for_page(plan.insert[-1].page)
+        return self._upload_payloads(plan.push_remote)
+
+
+
+    def _finish_download(self, seen, newest, full):
+        if full:
+            self._confirm_tombstones(seen)
+        self._advance_sync_watermark(newest, full)
+
+
+
+    def _take_over_remote_content(self, pairs):
+        for local, remote in pairs:
+            _logger.debug(str('remote annotation is more recent than local annotation, timestamps are remote: %d, local %d' % (remote.get_modified(), local.get_modified())))
+            local.set_note_title(remote.get_note_title())
+            local.set_note_body(remote.get_note_body())
+            local.set_modified(remote.get_modified())
+            self._write_annotation_db_record(local)
+
+
+
+    def _get_uuid_ann_map(self):
+        return dict([(a.get_uuid(), a) for a in self._annotations])
+
+
+
+    def _get_sync_state(self):
+        # (remote_modified, last_full_sync, last_push, remote_seq), None
+        # until known
+        if self._sync_state is None:
+            row = self._conn.execute('select remote_modified, last_full_sync, last_push, remote_seq from sync_state where md5=?', (self._filehash, )).fetchone()
+            self._sync_state = list(row or (None, None, None, None))
+        return self._sync_state
+
+
+
+    def _save_sync_state(self):
+        self._writer.execute('insert or replace into sync_state (md5, remote_modified, last_full_sync, last_push, remote_seq) values (?, ?, ?, ?, ?)', tuple([self._filehash] + self._sync_state))
+
+
+
+    def _add_sync_watermark(self, values):
+        # Asks the server only for annotations stored after the newest
+        # one seen so far, or if it does not number them, modified at or
+        # after it. Returns True for a full fetch.
+        remote_modified, last_full_sync, last_push, remote_seq = self._get_sync_state()
+        if last_full_sync is None:
+            return True
+        age = time.time() - last_full_sync
+        if remote_seq is not None and age <= _FULL_SYNC_INTERVAL:
+            values['after_seq'] = remote_seq
+            return False
+        if remote_modified is not None and age <= _FULL_SYNC_INTERVAL_BY_MODIFIED:
+            values['modified_since'] = remote_modified
+            return False
+        return True
+
+
+
+    def _note_newest(self, a, newest):
+        # Raises newest, a [modified, seq] list, to the values of the
+        # remote annotation a where they are newer
+        for i, key, kind in ((0, 'modified', float), (1, 'seq', int)):
+            try:
+                value = kind(a[key])
+            except (KeyError, TypeError, ValueError):
+                continue
+            if newest[i] is None or value > newest[i]:
+                newest[i] = value
+
+
+
+    def _advance_sync_watermark(self, newest, full):
+        # Only called once a download has been merged whole; newest is
+        # the [modified, seq] list of the answer
+        state = self._get_sync_state()
+        modified, seq = newest
+        if modified is not None and (state[0] is None or modified > state[0]):
+            state[0] = modified
+        if seq is not None and (state[3] is None or seq > state[3]):
+            state[3] = seq
+        if full:
+            state[1] = time.time()
+        self._save_sync_state()
+
+
+
+    def _confirm_tombstones(self, remote_uuids):
+        # Tombstones only stop deleted annotations from being downloaded
+        # again; once the server no longer has them they can be purged
+        remote_uuids = set(remote_uuids)
+        rows = self._conn.execute('select uuid from deleted_annotations where md5=? and confirmed=0', (self._filehash, ))
+        gone = [(r[0], ) for r in rows if r[0] not in remote_uuids]
+        if gone:
+            self._writer.executemany('update deleted_annotations set confirmed=1 where uuid=?', gone)
 
 
 
@@ -694,111 +1461,297 @@ class AnnotationManager:
 
 
 
-    def sync_annotations(self):
-        url         = self._annotationserver
-        annotations = []
-        annojson    = None
-        _logger.debug("contacting annotationserver %s", url)
+    def _sync_job(self, job):
+        # Runs on the sync worker; each yield runs a step on the main loop
+        url = self._annotationserver
+        user, userid, known = yield (self._lookup_sync_user, ())
+        if not userid:
+            userid = self._fetch_userid(user)
+            yield (self._set_sync_user, (user, userid, known))
+
+        self._replay_outbox(job)
+        data, push_started, uuid_map = yield (self._prepare_sync, ())
+        job.progress('fetch', 0, 1)
+        response = post(url, data, stream=True)
+        seen = set()
+        payloads = []
+        try:
+            first = response.read()
+            if not first:
+                return
+            for anno_arr in self._iter_remote_batches(itertools.chain([first], response)):
+                payloads += yield (self._merge_sync, (anno_arr, seen, uuid_map))
+        finally:
+            response.close()
+        job.progress('fetch', 1, 1)
+
+        payloads += yield (self._unsynced_payloads, (seen, uuid_map))
+        if payloads:
+            urls, ok = self._upload_annotations(job, payloads)
+            yield (self._finish_upload, (payloads, urls))
+        yield (self._finish_sync, (push_started, ))
+
+
+
+    def _drain_job(self, job):
+        self._replay_outbox(job)
+        # done_cb then finds what was replayed written out
+        yield (self._book.flush, ())
+
+
+
+    def _lookup_sync_user(self):
+        if self._userid != '':
+            return None, self._userid, True
+        client = gconf.client_get_default()
+        user = self.get_user_string(client.get_string("/desktop/sugar/user/nick"))
+        userid, known = self._lookup_userid(user)
+        if userid:
+            self._userid = userid
+        return user, userid, known
+
+
+
+    def _set_sync_user(self, user, userid, known):
+        self._store_userid(user, userid, known)
+        self._userid = userid
+
+
+
+    def _prepare_sync(self):
+        # Returns the fetch request and the push start time. The fetch
+        # starts from the download watermark: a sync only takes over
+        # changes to annotations that are here already.
+        _logger.debug("contacting annotationserver %s", self._annotationserver)
         #if self._annotates == "":
         #    self._annotates = self._texttitle
-        #check if there are annotations to be deleted:
-        if len(self._to_delete) > 0:
-            for delete_anid in self._to_delete:
-                if len(self._annotates) > 0:
-                    values = {'w3c_hasTarget' : self._annotates, 'delete_anid': delete_anid }
-                else:
-                    values = {'checksum' : self._filehash, 'delete_anid': delete_anid }
-                try:
-                    data = urllib.urlencode(values)          
-                    req = urllib2.Request(url, data)
-                    response = urllib2.urlopen(req)
-                    annojson = response.read() 
-                    self._to_delete.remove(delete_anid)    
-                    _logger.debug("\nafter delete, json is: %s\n\n" % annojson)
-                except Exception, detail: 
-                    _logger.debug("readdb: failure at request f. deleting annotations; detail: %s ", detail)
+        self._creator = self._userid
+        push_started = time.time()
+        #get annotations from server
+        if len(self._annotates) > 0:
+            values = {'w3c_hasTarget' : self._annotates }
         else:
-            #get annotations from server
-            client = gconf.client_get_default()
-            user = client.get_string("/desktop/sugar/user/nick")
-            if self._userid == '':
-                self._userid = self.get_userid_for_username( self.get_user_string( user ) )
-            self._creator = self._userid 
-            if len(self._annotates) > 0:
-                values = {'w3c_hasTarget' : self._annotates }
-            else:
-                values = {'checksum' : self._filehash }
+            values = {'checksum' : self._filehash }
+        self._add_sync_watermark(values)
+        _logger.debug('sync annotations -- annotates is: %s ' % self._annotates)
+        # a sync adds no annotations, so one map serves every batch
+        return urllib.urlencode(values), push_started, self._get_uuid_ann_map()
+
 
-            _logger.debug('sync annotations -- annotates is: %s ' % self._annotates)
+
+    def _merge_sync(self, anno_arr, seen, uuid_map):
+        # Merges a batch of the answer: takes over newer remote content and
+        # returns the upload payloads of our annotations the server has
+        # older copies of
+        _logger.debug('length anno_arr %d', len(anno_arr))
+        plan = plan_merge(uuid_map, anno_arr, (),
+                          self._userid, self.modifiedtolerance,
+                          insert_new=False, seen=seen)
+        _logger.debug('merge plan: %d updated, %d to send, %d skipped', len(plan.update_local), len(plan.push_remote), len(plan.skip))
+        self._take_over_remote_content(plan.update_local)
+        return self._upload_payloads(plan.push_remote)
+
+
+
+    def _unsynced_payloads(self, seen, uuid_map):
+        # The upload payloads of our annotations the answer did not
+        # mention that the server may be missing
+        plan = plan_merge(uuid_map, (), (),
+                          self._userid, self.modifiedtolerance,
+                          insert_new=False, push_unsynced=True,
+                          last_push=self._get_sync_state()[2], seen=seen)
+        return self._upload_payloads(plan.push_remote)
+
+
+
+    def _finish_sync(self, push_started):
+        # annotations that failed to go out wait in the outbox, so the
+        # next push can start from here all the same. The remote
+        # watermark stays put: a sync does not insert the new remote
+        # annotations, which the next download still has to fetch.
+        self._get_sync_state()[2] = push_started
+        self._save_sync_state()
+
+
+
+    def _upload_payloads(self, annotations):
+        return [(a.get_id(), a.get_uuid(), a.get_json_dict()) for a in annotations]
+
+
+
+    def _upload_annotations(self, job, payloads):
+        # Runs on the sync worker. Uploads in batches: the server takes a
+        # JSON array and answers with {uuid: {'annotationurl': ...,
+        # 'bodyurl': ...}}. Servers that do not take arrays get one
+        # request per annotation instead. Returns {id: (annotationurl,
+        # bodyurl)} and whether every annotation was stored.
+        url = self._annotationserver
+        headers = {'Content-Type': 'application/json', "Accept": "application/json"}
+        urls = {}
+        ok = True
+        for start in range(0, len(payloads), _UPLOAD_BATCH_SIZE):
+            if job is not None:
+                if job.is_cancelled():
+                    raise SyncCancelled()
+                job.progress('upload', start, len(payloads))
+            batch = payloads[start:start + _UPLOAD_BATCH_SIZE]
             try:
-                data        = urllib.urlencode(values)          
-                req         = urllib2.Request(url, data)
-                response    = urllib2.urlopen(req)
-                annojson    = response.read() 
-                _logger.debug('downloaded annotations -- annojson is: %s ' % annojson)
-            except Exception, detail: 
-                _logger.debug("readdb: failure at initial sync request f. annotations; detail: %s ", detail) 
-        if ( not annojson == None ) and ( len( annojson ) > 0 ):    
-            anno_arr = self.parse_annotations(annojson)  
-            _logger.debug('length anno_arr %d', len(anno_arr))
-            remote_uuids = []
-            if len(anno_arr) > 0:
-                localuuids = [la.get_uuid() for la in self._annotations]
-                remote_uuids = [a.get_uuid() for a in anno_arr]
-                _logger.debug('remote_uuids %s', remote_uuids)
-                #check the modified timestamps
-                for a in anno_arr:
-                    uuid = a.get_uuid()
-                    if uuid in localuuids:
-                        _logger.debug('uuid exists locally')
-                        ind = localuuids.index(uuid)
-                        rmodifiedtstamp = a.get_modified()
-                        _logger.debug(str('timestamps are remote: %d, local %d' % (rmodifiedtstamp, self._annotations[ind].get_modified())))
-                        if self._annotations[ind].get_modified() < rmodifiedtstamp - self.modifiedtolerance:
-                            _logger.debug('remote annotation is more recent than local annotation')
-                            #take over the content
-                            self._annotations[ind].set_note_title(a.get_note_title())
-                            self._annotations[ind].set_note_body(a.get_note_body())
-                            self._annotations[ind].set_modified(rmodifiedtstamp) 
-                            _logger.debug(str('after update: timestamps are remote: %d, local %d' % (rmodifiedtstamp, self._annotations[ind].get_modified())))
-                            self.update_annotation_db_record(a)
-                        else:
-                            if self._annotations[ind].get_creator() == self._userid:
-                                _logger.debug(str('remote annotation is outdated, sending %s' % self._annotations[ind]))
-                                self.send_annotation_to_server(self._annotations[ind])
-
-            if (len(self._annotations) > 0):
-                #send annotations if necessary 
-                for annotation in self._annotations:
-                    if ( not annotation.get_uuid() in remote_uuids ) and ( len( annotation.get_creator() ) > 0 ) and ( annotation.get_creator() == self._userid ): 
-                        self.send_annotation_to_server(annotation)
+                result = simplejson.loads(post(url, simplejson.dumps([p[2] for p in batch]), headers, compress=True))
+                # an older server may answer an array with a single record
+                if not isinstance(result, dict) or \
+                        not [p for p in batch if p[1] in result]:
+                    raise ValueError('not a batch response')
+            except (HTTPError, ValueError), detail:
+                _logger.debug("readdb: batch upload not supported (%s), sending one by one", detail)
+                for aid, uuid, annotation in batch:
+                    try:
+                        json_arr = simplejson.loads(post(url, simplejson.dumps(annotation), headers, compress=True))
+                        _logger.debug('json response from the server: %s', json_arr)
+                        urls[aid] = (json_arr['annotationurl'], json_arr['bodyurl'])
+                    except Exception, detail:
+                        _logger.debug("readdb: sending annotation failed: %s ", detail)
+                        ok = False
+                continue
+
+            for aid, uuid, annotation in batch:
+                stored = result.get(uuid)
+                if stored:
+                    urls[aid] = (stored.get('annotationurl'), stored.get('bodyurl'))
+                else:
+                    ok = False
+        if job is not None:
+            job.progress('upload', len(payloads), len(payloads))
+        return urls, ok
 
 
 
-    def send_annotation_to_server(self, annotation):
+    def _delete_request(self, uuid):
+        if len(self._annotates) > 0:
+            values = {'w3c_hasTarget' : self._annotates, 'delete_anid': uuid }
+        else:
+            values = {'checksum' : self._filehash, 'delete_anid': uuid }
+        return urllib.urlencode(values)
+
+
+
+    def _due_outbox_ops(self):
+        # The outbox operations of this book that are due, as delete
+        # requests and upload payloads
+        self._book.flush()
+        rows = self._conn.execute('select op, uuid from outbox where md5=? and next_attempt<=? order by next_attempt limit ?', (self._filehash, time.time(), _OUTBOX_BATCH_SIZE)).fetchall()
+        uuid_map = self._get_uuid_ann_map()
+        deletes = []
+        uploads = []
+        gone = []
+        for op, uuid in rows:
+            if op == 'delete':
+                deletes.append((uuid, self._delete_request(uuid)))
+            elif uuid in uuid_map:
+                uploads.append(uuid_map[uuid])
+            else:
+                gone.append((uuid, ))
+        if gone:
+            # deleted or dropped since, so there is nothing left to send
+            self._writer.executemany("delete from outbox where op='upload' and uuid=?", gone)
+        return deletes, self._upload_payloads(uploads)
+
+
+
+    def _replay_outbox(self, job):
+        # Runs on the sync worker. Sends what is due in the outbox a batch
+        # at a time, and stops at the first batch that does not all go
+        # through; when the server cannot be reached at all, everything
+        # in the batch waits for its next retry.
         url = self._annotationserver
-        annojson = annotation.get_json()
-        _logger.debug('it is a new or updated annotation, trying to send it to server, json: %s', annojson)
-        try:
-            req = urllib2.Request(url, annojson, {'Content-Type': 'application/json', "Accept": "application/json"} )
-            #req = urllib2.Request(url, annojson, {"Content-type": "application/x-www-form-urlencoded"y} )
-            response = urllib2.urlopen(req)       
-            re_json = response.read()
-            json_arr = simplejson.loads(re_json)
-            _logger.debug('json response from the server: %s', re_json )
-            
-            annourl = json_arr['annotationurl']
-            _logger.debug('got this annourl back from server: %s', annourl )
+        while True:
+            deletes, payloads = job.call(self._due_outbox_ops)
+            if not deletes and not payloads:
+                return
+            done = []
+            failed = []
+            reachable = True
+            for i, (uuid, data) in enumerate(deletes):
+                if job.is_cancelled():
+                    raise SyncCancelled()
+                job.progress('delete', i, len(deletes))
+                try:
+                    post(url, data)
+                except HTTPError, detail:
+                    _logger.debug("readdb: server refused to delete annotation %s: %s", uuid, detail)
+                    failed.append(uuid)
+                    continue
+                except Exception, detail:
+                    _logger.debug("readdb: failure at request f. deleting annotations; detail: %s ", detail)
+                    failed.extend([d[0] for d in deletes[i:]])
+                    reachable = False
+                    break
+                done.append(uuid)
+
+            urls = {}
+            if payloads and reachable:
+                try:
+                    urls, ok = self._upload_annotations(job, payloads)
+                except SyncCancelled:
+                    raise
+                except Exception, detail:
+                    _logger.debug("readdb: sending annotations failed: %s ", detail)
+            job.call(self._record_outbox_results, 'delete', done, failed)
+            job.call(self._finish_upload, payloads, urls)
+            _logger.debug('outbox: %d deletes and %d uploads went through', len(done), len(urls))
+            if failed or len(urls) < len(payloads):
+                return
+
+
+
+    def _record_outbox_results(self, op, done, failed):
+        # Clears the operations that went through and puts off the failed
+        # ones, which join the outbox if they are not in it yet
+        if done:
+            self._writer.executemany('delete from outbox where op=? and uuid=?',
+                                     [(op, uuid) for uuid in done])
+        if failed:
+            now = time.time()
+            self._writer.executemany('insert or ignore into outbox (op, uuid, md5) values (?, ?, ?)',
+                                     [(op, uuid, self._filehash) for uuid in failed])
+            self._writer.executemany('update outbox set attempts=attempts+1, '
+                                     'next_attempt=? + min(?, ? * (1 << min(attempts, 20))) where op=? and uuid=?',
+                                     [(now, _OUTBOX_MAX_DELAY, _OUTBOX_BASE_DELAY, op, uuid) for uuid in failed])
+
+
+
+    def _finish_upload(self, payloads, urls):
+        self._apply_annotation_urls(urls)
+        self._record_outbox_results('upload',
+                [p[1] for p in payloads if p[0] in urls],
+                [p[1] for p in payloads if p[0] not in urls])
+
+
+
+    def _apply_annotation_urls(self, urls):
+        # Stores the urls assigned by the server with one executemany
+        rows = []
+        for aid, (annourl, bodyurl) in urls.iteritems():
+            annotation = self._id_ann_map.get(aid)
+            if annotation is None:
+                continue
             if annourl != None:
                 annotation.set_annotationurl( annourl )
-            
-            bodyurl = json_arr['bodyurl']
-            _logger.debug('got this bodyurl back from server: %s', bodyurl)
             if bodyurl != None:
                 annotation.set_bodyurl(bodyurl)
-            
-            self.update_annotation_db_record( annotation )
-        except Exception, detail:
-          _logger.debug("readdb: sending annotation failed: %s ", detail)
+            rows.append((annotation.get_annotationurl(), annotation.get_bodyurl(), aid))
+        if rows:
+            self._writer.executemany('update annotations set annotationurl=?, bodyurl=? where id=?', rows)
 
 
+
+    def send_annotation_to_server(self, annotation):
+        # Blocks until the server answers; syncs upload on their worker.
+        # If the annotation does not get through it goes to the outbox.
+        payloads = self._upload_payloads([annotation])
+        urls = {}
+        try:
+            urls, ok = self._upload_annotations(None, payloads)
+        except Exception, detail:
+            _logger.debug("readdb: sending annotation failed: %s ", detail)
+        self._finish_upload(payloads, urls)
+        return len(urls) > 0
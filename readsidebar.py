@@ -116,6 +116,14 @@ class Sidebar(gtk.EventBox):
         return (self._annotation_manager)
     
 
+    def set_bookmarkmanager(self, bookmark_manager):
+        self._bookmark_manager = bookmark_manager
+
+
+    def get_bookmarkmanager(self):
+        return self._bookmark_manager
+    
+
     def update_for_page(self, page): 
         self._clear_annotations()
         annotations = self._annotation_manager.get_annotations_for_page(page)
@@ -123,12 +131,16 @@ class Sidebar(gtk.EventBox):
             self._add_annotation_icon(annotation)
 
     
-    def sync_annotations(self):
-        self._annotation_manager.sync_annotations()
+    def sync_annotations(self, done_cb=None, progress_cb=None):
+        return self._annotation_manager.sync_annotations(done_cb, progress_cb)
+
+
+    def download_annotations(self, done_cb=None, progress_cb=None):
+        return self._annotation_manager.download_annotations(done_cb, progress_cb)
 
 
-    def download_annotations(self):
-        self._annotation_manager.download_annotations()
+    def cancel_sync(self):
+        self._annotation_manager.cancel_sync()
 
 
     def add_annotation(self, page):
@@ -0,0 +1,97 @@
+# Copyright 2009 One Laptop Per Child
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301  USA
+
+import gtk
+
+# Ticks never get thinner than this, in pixels
+_MIN_TICK = 2
+
+
+class ScrollMarkers:
+    """Draws a tick along a scrollbar for every page that has annotations.
+
+    Pages are numbered from first_page to first_page + get_pagecount() - 1.
+    With page_values the scrollbar's values are page numbers, and a tick
+    sits where the slider is for its page; otherwise the scrollbar is
+    taken to span the whole document evenly. The more annotations a page
+    has, compared with the busiest page, the wider its tick.
+    """
+    def __init__(self, scrollbar, get_pagecount, first_page=0,
+                 page_values=False):
+        self._scrollbar = scrollbar
+        self._get_pagecount = get_pagecount
+        self._first_page = first_page
+        self._page_values = page_values
+        self._counts = {}
+        self._scrollbar.connect_after('expose-event', self.__expose_event_cb)
+
+    def set_page_counts(self, counts):
+        self._counts = counts
+        self._scrollbar.queue_draw()
+
+    def _get_trough(self, widget):
+        # The trough is what is left between the stepper buttons
+        alloc = widget.allocation
+        stepper = widget.style_get_property('stepper-size')
+        border = widget.style_get_property('trough-border')
+        top = stepper * (int(widget.style_get_property('has-backward-stepper')) +
+                int(widget.style_get_property('has-secondary-forward-stepper')))
+        bottom = stepper * (int(widget.style_get_property('has-forward-stepper')) +
+                int(widget.style_get_property('has-secondary-backward-stepper')))
+        return (alloc.x + border, alloc.y + top + border,
+                alloc.width - 2 * border, alloc.height - top - bottom - 2 * border)
+
+    def _get_position(self, widget, page, pagecount):
+        # Where page is along the trough, from 0 to 1
+        if not self._page_values:
+            return (page - self._first_page) / float(pagecount)
+        adjustment = widget.get_adjustment()
+        span = adjustment.upper - adjustment.lower
+        if span <= 0:
+            return 0.0
+        return min(1.0, max(0.0, (page - adjustment.lower) / span))
+
+    def __expose_event_cb(self, widget, event):
+        if not self._counts:
+            return False
+        pagecount = self._get_pagecount()
+        if pagecount < 1:
+            return False
+
+        x, y, width, height = self._get_trough(widget)
+        if width <= 0 or height <= 0:
+            return False
+        tick = max(_MIN_TICK, height / float(pagecount))
+        max_count = max(self._counts.values())
+
+        color = widget.style.bg[gtk.STATE_SELECTED]
+        cr = widget.window.cairo_create()
+        cr.rectangle(event.area.x, event.area.y,
+                     event.area.width, event.area.height)
+        cr.clip()
+        cr.set_source_rgba(color.red / 65535.0, color.green / 65535.0,
+                           color.blue / 65535.0, 0.7)
+        last_page = self._first_page + pagecount - 1
+        for page, count in self._counts.iteritems():
+            if page < self._first_page or page > last_page or count <= 0:
+                continue
+            tick_width = max(_MIN_TICK, width * count / float(max_count))
+            position = self._get_position(widget, page, pagecount)
+            cr.rectangle(x + (width - tick_width) / 2.0,
+                         y + min(height * position, height - tick),
+                         tick_width, tick)
+        cr.fill()
+        return False
@@ -0,0 +1,184 @@
+# Copyright 2009 One Laptop Per Child
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301  USA
+
+# Checks that the annotation cache of readdb.AnnotationManager matches
+# the database after each kind of change. gconf, gobject and the sugar
+# modules are stubbed, so this runs without GTK or a Sugar session:
+#
+#   python tests/test_annocache.py
+
+import os
+import sys
+import shutil
+import tempfile
+import types
+import unittest
+
+_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, _ROOT)
+
+
+def _stub(name, **attrs):
+    module = types.ModuleType(name)
+    module.__dict__.update(attrs)
+    sys.modules[name] = module
+    return module
+
+
+class _GConfClient:
+    def get_string(self, key):
+        return {'/desktop/sugar/user/nick': 'tester',
+                '/desktop/sugar/user/color': '#FF0000,#00FF00'}.get(key)
+
+
+class _XoColor:
+    def __init__(self, color=None):
+        self._color = color or '#000000,#FFFFFF'
+
+    def to_string(self):
+        return self._color
+
+
+_stub('gconf', client_get_default=_GConfClient)
+_stub('gobject', idle_add=lambda *args, **kwargs: 0,
+      timeout_add_seconds=lambda *args, **kwargs: 0, PRIORITY_LOW=300)
+_stub('sugar')
+_stub('sugar.datastore')
+_stub('sugar.datastore.datastore', find=lambda *args, **kwargs: ([], 0))
+_stub('sugar.mime', GENERIC_TYPE_TEXT='Text')
+_stub('sugar.graphics')
+_stub('sugar.graphics.xocolor', XoColor=_XoColor)
+sys.modules['sugar'].datastore = sys.modules['sugar.datastore']
+sys.modules['sugar.datastore'].datastore = sys.modules['sugar.datastore.datastore']
+sys.modules['sugar'].mime = sys.modules['sugar.mime']
+sys.modules['sugar'].graphics = sys.modules['sugar.graphics']
+sys.modules['sugar.graphics'].xocolor = sys.modules['sugar.graphics.xocolor']
+try:
+    import simplejson
+except ImportError:
+    import json as simplejson
+    sys.modules['simplejson'] = simplejson
+
+_ACTIVITY_ROOT = tempfile.mkdtemp()
+os.environ['SUGAR_ACTIVITY_ROOT'] = _ACTIVITY_ROOT
+os.environ['SUGAR_BUNDLE_PATH'] = _ROOT
+os.environ['ANNO_SERVER_URL'] = 'http://127.0.0.1:9/'
+
+import readdb
+from annobookmark import AnnoBookmark
+from annobundle import BUNDLE_VERSION
+
+_BUNDLE_COLUMNS = ('page', 'title', 'content', 'bodyurl', 'texttitle',
+        'textcreator', 'created', 'modified', 'creator', 'annotates', 'color',
+        'local', 'mimetype', 'uuid', 'annotationurl')
+
+
+class _Sidebar:
+    def update_for_page(self, page):
+        pass
+
+
+def _note(title, body='body'):
+    return simplejson.dumps({'title': title, 'body': body})
+
+
+def _remote(i, filehash):
+    return AnnoBookmark((0, filehash, i % 5, 'remote %d' % i, 'content',
+                         '', '', '', 1.0, 2.0, 'someone', '',
+                         '#FF0000,#00FF00', 0, 'text/plain',
+                         'urn:test:%s:%d' % (filehash, i), None))
+
+
+class AnnotationCacheTest(unittest.TestCase):
+
+    def setUp(self):
+        self._count = getattr(AnnotationCacheTest, '_count', 0) + 1
+        AnnotationCacheTest._count = self._count
+        self.filehash = 'book%d' % self._count
+        self.manager = self._manager(self.filehash)
+
+    def _manager(self, filehash):
+        manager = readdb.AnnotationManager(filehash, 'text/plain', _Sidebar())
+        manager._userid = 'tester-id'
+        return manager
+
+    def assertConsistent(self, manager=None):
+        manager = manager or self.manager
+        manager.flush()
+        self.assertEqual(manager.verify_annotation_cache(), [])
+
+    def _add(self, pages):
+        for page in pages:
+            self.manager.add_annotation(page, _note('note on %d' % page))
+
+    def test_add(self):
+        self._add([3, 1, 3, 7])
+        self.assertConsistent()
+        self.assertEqual(len(self.manager.get_annotations_for_page(3)), 2)
+
+    def test_edit(self):
+        self._add([2, 4])
+        aid = self.manager.get_annotations_for_page(4)[0].id
+        self.manager.edit_annotation(4, _note('edited', 'new body'), aid)
+        self.assertConsistent()
+        self.assertEqual(self.manager.get_annotations_for_page(4)[0].get_note_title(), 'edited')
+
+    def test_delete(self):
+        self._add([1, 1, 5])
+        aid = self.manager.get_annotations_for_page(1)[0].id
+        self.manager.del_annotation(aid)
+        self.assertConsistent()
+        self.assertEqual(len(self.manager.get_annotations_for_page(1)), 1)
+
+    def test_import_annotations(self):
+        self._add([0])
+        self.manager.import_annotations([_remote(i, self.filehash) for i in range(20)])
+        self.assertConsistent()
+        self.assertEqual(len(self.manager.get_annotations_for_page(0)), 5)
+
+    def _write_bundle(self, path, uuids):
+        # a bundle as another machine would export it for this book
+        fileobj = open(path, 'w')
+        fileobj.write(simplejson.dumps({'version': BUNDLE_VERSION,
+                                        'md5': self.filehash,
+                                        'a': _BUNDLE_COLUMNS}) + '\n')
+        for i, uuid in enumerate(uuids):
+            fileobj.write(simplejson.dumps(['a', i % 3, 'bundled %d' % i,
+                    'content', '', '', '', 1.0, 2.0, 'someone', '',
+                    '#FF0000,#00FF00', 0, 'text/plain', uuid, None]) + '\n')
+        fileobj.close()
+
+    def test_import_bundle(self):
+        self._add([1, 2])
+        path = os.path.join(_ACTIVITY_ROOT, '%s.bundle' % self.filehash)
+        known = self.manager.get_annotations_for_page(1)[0].get_uuid()
+        self._write_bundle(path, [known] + ['urn:bundle:%d' % i for i in range(6)])
+
+        self.manager.import_bundle(path)
+        self.assertConsistent()
+        self.assertEqual(len(self.manager.get_annotations_for_page(1)), 3)
+
+        # a second import skips what is known by uuid
+        self.manager.import_bundle(path)
+        self.assertConsistent()
+        self.assertEqual(len(self.manager.get_annotations_for_page(1)), 3)
+
+
+if __name__ == '__main__':
+    try:
+        unittest.main()
+    finally:
+        shutil.rmtree(_ACTIVITY_ROOT, ignore_errors=True)
@@ -0,0 +1,144 @@
+# Copyright 2009 One Laptop Per Child
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301  USA
+
+# Tests for annomerge.plan_merge:
+#
+#   python tests/test_annomerge.py
+
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from annomerge import plan_merge
+
+
+class _Anno:
+    def __init__(self, uuid, modified, creator='me', annotationurl=None):
+        self.uuid = uuid
+        self.modified = modified
+        self.creator = creator
+        self.annotationurl = annotationurl
+
+    def __repr__(self):
+        return '_Anno(%r, %r, %r)' % (self.uuid, self.modified, self.creator)
+
+
+def _local(*annotations):
+    return dict([(a.uuid, a) for a in annotations])
+
+
+class PlanMergeTest(unittest.TestCase):
+
+    def test_insert(self):
+        new = _Anno('u1', 10, 'other')
+        plan = plan_merge({}, [new], owner='me')
+        self.assertEqual(plan.insert, [new])
+        self.assertEqual(plan.skip, [])
+
+    def test_insert_new_off_skips(self):
+        new = _Anno('u1', 10, 'other')
+        plan = plan_merge({}, [new], owner='me', insert_new=False)
+        self.assertEqual(plan.insert, [])
+        self.assertEqual(plan.skip, [new])
+
+    def test_update_local(self):
+        local = _Anno('u1', 100)
+        remote = _Anno('u1', 200)
+        plan = plan_merge(_local(local), [remote], owner='me', tolerance=10)
+        self.assertEqual(plan.update_local, [(local, remote)])
+        self.assertEqual(plan.push_remote, [])
+
+    def test_within_tolerance_skips(self):
+        local = _Anno('u1', 195, 'other')
+        remote = _Anno('u1', 200, 'other')
+        plan = plan_merge(_local(local), [remote], owner='me', tolerance=10)
+        self.assertEqual(plan.update_local, [])
+        self.assertEqual(plan.skip, [remote])
+
+    def test_push_remote(self):
+        local = _Anno('u1', 300)
+        remote = _Anno('u1', 200)
+        plan = plan_merge(_local(local), [remote], owner='me')
+        self.assertEqual(plan.push_remote, [local])
+        self.assertEqual(plan.update_local, [])
+
+    def test_newer_local_of_another_creator_skips(self):
+        local = _Anno('u1', 300, 'other')
+        remote = _Anno('u1', 200, 'other')
+        plan = plan_merge(_local(local), [remote], owner='me')
+        self.assertEqual(plan.push_remote, [])
+        self.assertEqual(plan.skip, [remote])
+
+    def test_tombstone_skips(self):
+        remote = _Anno('u1', 10, 'other')
+        plan = plan_merge({}, [remote], tombstones=['u1'], owner='me')
+        self.assertEqual(plan.insert, [])
+        self.assertEqual(plan.skip, [remote])
+
+    def test_duplicate_remote_skips(self):
+        first = _Anno('u1', 10, 'other')
+        again = _Anno('u1', 20, 'other')
+        plan = plan_merge({}, [first, again], owner='me')
+        self.assertEqual(plan.insert, [first])
+        self.assertEqual(plan.skip, [again])
+
+    def test_seen_across_parts(self):
+        seen = set()
+        first = _Anno('u1', 10, 'other')
+        plan = plan_merge({}, [first], owner='me', seen=seen)
+        self.assertEqual(plan.insert, [first])
+        self.assertEqual(seen, set(['u1']))
+
+        again = _Anno('u1', 10, 'other')
+        second = _Anno('u2', 10, 'other')
+        plan = plan_merge({}, [again, second], owner='me', seen=seen)
+        self.assertEqual(plan.insert, [second])
+        self.assertEqual(plan.skip, [again])
+        self.assertEqual(seen, set(['u1', 'u2']))
+
+    def test_push_unsynced(self):
+        mentioned = _Anno('u1', 100, annotationurl='http://x/1')
+        unsent = _Anno('u2', 50)
+        changed = _Anno('u3', 500, annotationurl='http://x/3')
+        unchanged = _Anno('u4', 50, annotationurl='http://x/4')
+        foreign = _Anno('u5', 500, 'other')
+        local = _local(mentioned, unsent, changed, unchanged, foreign)
+        plan = plan_merge(local, [_Anno('u1', 100)], owner='me',
+                          insert_new=False, push_unsynced=True,
+                          last_push=400)
+        self.assertEqual(sorted([a.uuid for a in plan.push_remote]),
+                         ['u2', 'u3'])
+
+    def test_push_unsynced_after_parts(self):
+        # the parts of the answer are remembered in seen, so the last
+        # call pushes only what no part mentioned
+        seen = set()
+        local = _local(_Anno('u1', 100), _Anno('u2', 100))
+        plan_merge(local, [_Anno('u1', 100)], owner='me', insert_new=False,
+                   seen=seen)
+        plan = plan_merge(local, (), owner='me', insert_new=False,
+                          push_unsynced=True, seen=seen)
+        self.assertEqual([a.uuid for a in plan.push_remote], ['u2'])
+
+    def test_push_unsynced_needs_owner(self):
+        plan = plan_merge(_local(_Anno('u1', 100)), (), push_unsynced=True)
+        self.assertEqual(plan.push_remote, [])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -151,6 +151,10 @@ class TextViewer(gobject.GObject):
     def connect_page_changed_handler(self, handler):
         self.connect('page-changed', handler)
 
+    def show_annotation_density(self, page_counts):
+        # the scrollbar only spans the current page
+        pass
+
     def can_do_text_to_speech(self):
         return True
 